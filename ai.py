@@ -1,340 +1,427 @@
-from typing import List, Tuple, Deque
+from typing import Callable, List, Tuple
+from array import array
 from collections import deque
-from board import Board, PromotionMove, Move, Unmove, Position, diagonal_directions, file_directions, knight_directions
+from dataclasses import dataclass, field, replace
+import concurrent.futures
+import hashlib
+import multiprocessing
+import os
+import queue
+import threading
+import time
+from board import (
+    Board, Move, Unmove, square_positions, encode_move, decode_move,
+    PROMOTION_FLAG, values
+)
+from bitboard import (
+    pawn_attacks, knight_attacks, king_attacks,
+    rook_tables, rook_masks, bishop_tables, bishop_masks, squares_of, between, line, FULL
+)
+from transposition import TranspositionTable, EXACT, LOWER, UPPER
 import numpy
 
-def find_any_attacking_move(board: Board, pos: Position, player_sign):
-    # Search for pawns
-    for side in [-1, 1]:
-        src = pos + Position(side, -player_sign)
-
-        if not board.is_valid_position(src):
-            continue
-
-        if board[src] == player_sign * 1:
-            return Move(src, pos)
-
-    # Search for rooks/queens
-    for dir in file_directions:
-        for dist in range(1, 8):
-            src = pos + dist * dir
-
-            if not board.is_valid_position(src):
-                break
-            
-            if board.occupied(src):
-                piece = player_sign * board[src]
-                if piece in [4, 5]:
-                    return Move(src, pos)
-                break
-
-    # Search for bishops/queens
-    for dir in diagonal_directions:
-        for dist in range(1, 8):
-            src = pos + dist * dir
-
-            if not board.is_valid_position(src):
-                break
-
-            if board.occupied(src):
-                piece = player_sign * board[src]
-                if piece in [3, 5]:
-                    return Move(src, pos)
-                break
-    
-    # Search for horses
-    for dir in knight_directions:
-        src = pos + dir
-
-        if not board.is_valid_position(src):
-            continue
-
-        if player_sign * board[src] == 2:
-            return Move(src, pos)
-
-    # Search for kings
-    for dir in file_directions + diagonal_directions:
-        src = pos + dir
-
-        if not board.is_valid_position(src):
-            continue
-            
-        if board[src] == player_sign * 6:
-            return Move(src, pos)
-    
-    return None
-
-def find_all_possible_attacks(board: Board, pos: Position, player_sign):
-    attacks = []
-    # Search for pawns
-    for side in [-1, 1]:
-        src = pos + Position(side, -player_sign)
-
-        if not board.is_valid_position(src):
-            continue
-
-        piece = board[src]
-        if piece == player_sign * 1:
-            attacks.append((piece, Move(src, pos)))
-
-    # Search for rooks/queens
-    for dir in file_directions:
-        for dist in range(1, 8):
-            src = pos + dist * dir
-
-            if not board.is_valid_position(src):
-                break
-            
-            if board.occupied(src):
-                piece = board[src]
-                if player_sign == numpy.sign(piece):
-                    if abs(piece) in [4, 5]:
-                        attacks.append((piece, Move(src, pos)))
-                    else:
-                        break
+def castling_possible(board: Board, king_sq: int, rook_sq: int, player_sign):
+    if board.has_moved(square_positions[king_sq]) or board.has_moved(square_positions[rook_sq]):
+        return False
 
-    # Search for bishops/queens
-    for dir in diagonal_directions:
-        for dist in range(1, 8):
-            src = pos + dist * dir
+    if board.squares[rook_sq] != player_sign * 4:
+        return False
 
-            if not board.is_valid_position(src):
-                break
+    if board.occupancy[0] & between[king_sq][rook_sq]:
+        return False
 
-            if board.occupied(src):
-                piece = player_sign * board[src]
-                if player_sign == numpy.sign(piece):
-                    if abs(piece) in [3, 5]:
-                        attacks.append((piece, Move(src, pos)))
-                    else:
-                        break
-    
-    # Search for horses
-    for dir in knight_directions:
-        src = pos + dir
-
-        if not board.is_valid_position(src):
-            continue
-
-        if board.occupied(src):
-            piece = board[src]
-            if player_sign == numpy.sign(piece) and abs(piece) == 2:
-                attacks.append((piece, Move(src, pos)))
-
-    # Search for kings
-    for dir in file_directions + diagonal_directions:
-        src = pos + dir
-
-        if not board.is_valid_position(src):
-            continue
-        
-        piece = board[src]
-        if piece == player_sign * 6:
-            attacks.append((piece, Move(src, pos)))
-
-    return attacks
-
-def castling_possible(board, king_position, rook_position, player_sign):
-    dir = Position(-1 if king_position.x > rook_position.x else 1, 0)
-    for dist in range(1, abs(rook_position.x - king_position.x)):
-        middle_position = king_position + dist * dir
-        if board[middle_position] != 0:
+    # No castling out of, through or into check
+    step = 1 if rook_sq > king_sq else -1
+    for sq in [king_sq, king_sq + step, king_sq + 2 * step]:
+        if board.is_attacked(sq, -player_sign):
             return False
 
-        if dist < 3:
-            if find_any_attacking_move(board, middle_position, -1 * player_sign) is not None:
-                return False
+    return True
 
-    if not board.has_moved(king_position) and not board.has_moved(rook_position):
-        return True
+def promote_move_if_possible(moves, src: int, dst: int):
+    if dst < 8 or dst >= 56:
+        move = src | (dst << 6) | (PROMOTION_FLAG << 14)
+        moves.append(move)
+        moves.append(move | (1 << 12))
+        moves.append(move | (2 << 12))
+        moves.append(move | (3 << 12))
     else:
-        return False
+        moves.append(src | (dst << 6))
 
-def promote_move_if_possible(moves, src, dst, player_sign):
-    if dst.y in [0, 7]:
-        moves.append(PromotionMove(src, dst, player_sign * 2))
-        moves.append(PromotionMove(src, dst, player_sign * 3))
-        moves.append(PromotionMove(src, dst, player_sign * 4))
-        moves.append(PromotionMove(src, dst, player_sign * 5))
-    else:
-        moves.append(Move(src, dst))
+def add_moves(moves, src: int, targets: int):
+    while targets:
+        low = targets & -targets
+        moves.append(src | ((low.bit_length() - 1) << 6))
+        targets ^= low
 
-def find_moves(board: Board, src: Position):
+def find_moves(board: Board, sq: int, target_mask: int = FULL):
+    # Pseudo-legal moves of the piece on sq, packed as by encode_move. Only
+    # moves ending on target_mask are generated, except en passant captures.
     moves = []
-    signed_piece = board[src]
-    player_sign = numpy.sign(signed_piece)
+    signed_piece = board.squares[sq]
+    player_sign = 1 if signed_piece > 0 else -1
     piece = abs(signed_piece)
     home_row = 0 if player_sign == 1 else 7
+    occupancy = board.occupancy[0]
+    not_own = ~board.occupancy[player_sign] & target_mask
 
     if piece == 1:
-        dst = Position(src.x, src.y + player_sign)
+        dst = sq + 8 * player_sign
 
-        if board.can_move_space(dst):
-            promote_move_if_possible(moves, src, dst, player_sign)
+        if 0 <= dst < 64 and board.squares[dst] == 0:
+            if target_mask & (1 << dst):
+                promote_move_if_possible(moves, sq, dst)
 
-            dst = Position(src.x, src.y + 2 * player_sign)
-            if src.y == home_row + player_sign and board.can_move_space(dst):
-                moves.append(Move(src, dst))
+            dst += 8 * player_sign
+            if sq >> 3 == home_row + player_sign and board.squares[dst] == 0 and target_mask & (1 << dst):
+                moves.append(sq | (dst << 6))
 
-        for side in [-1, 1]:
-            dst = Position(src.x + side, src.y + player_sign)
+        en_passant_pos = board.en_passant_pos
+        for dst in squares_of(pawn_attacks[player_sign][sq]):
             if (
-                board.can_capture_space(dst, player_sign) or
-                board.en_passant_pos == Position(src.x + side, src.y)
+                (player_sign * board.squares[dst] < 0 and target_mask & (1 << dst)) or
+                (
+                    en_passant_pos is not None and
+                    en_passant_pos.y == sq >> 3 and
+                    en_passant_pos.x == dst & 7
+                )
             ):
-                promote_move_if_possible(moves, src, dst, player_sign)
+                promote_move_if_possible(moves, sq, dst)
 
     elif piece == 2:
-        for dir in knight_directions:
-            dst = src + dir
-
-            if board.can_move_space(dst):
-                moves.append(Move(src, dst))
-            elif board.can_capture_space(dst, player_sign):
-                moves.append(Move(src, dst))
-    elif piece == 3 or piece == 5:
-        for dir in diagonal_directions:
-            for dist in range(1, 8):
-                dst = src + dist * dir
-
-                if board.can_move_space(dst):
-                    moves.append(Move(src, dst))
-                elif board.can_capture_space(dst, player_sign):
-                    moves.append(Move(src, dst))
-                    break
-                else:
-                    break
-    
-    if piece == 4 or piece == 5:
-        for dir in file_directions:
-            for dist in range(1, 8):
-                dst = src + dist * dir
-
-                if board.can_move_space(dst):
-                    moves.append(Move(src, dst))
-                elif board.can_capture_space(dst, player_sign):
-                    moves.append(Move(src, dst))
-                    break
-                else:
-                    break
+        add_moves(moves, sq, knight_attacks[sq] & not_own)
+    elif piece == 3:
+        add_moves(moves, sq, bishop_tables[sq][occupancy & bishop_masks[sq]] & not_own)
+    elif piece == 4:
+        add_moves(moves, sq, rook_tables[sq][occupancy & rook_masks[sq]] & not_own)
+    elif piece == 5:
+        add_moves(moves, sq, (
+            bishop_tables[sq][occupancy & bishop_masks[sq]] |
+            rook_tables[sq][occupancy & rook_masks[sq]]
+        ) & not_own)
     elif piece == 6:
-        for dir in diagonal_directions + file_directions:
-            dst = src + dir
-            if board.can_move_space(dst) or board.can_capture_space(dst, player_sign):
-                move = Move(src, dst)
-                unmove = board.move(move)
-                if find_any_attacking_move(board, dst, -1 * player_sign) is None:
-                    moves.append(move)
-                board.unmove(unmove)
+        # Take the king off the board so sliders see through to the squares
+        # behind it
+        without_king = occupancy ^ (1 << sq)
+        for dst in squares_of(king_attacks[sq] & not_own):
+            if not board.is_attacked(dst, -player_sign, without_king):
+                moves.append(sq | (dst << 6))
 
-        if src == Position(4, home_row):
-            dst = Position(6, home_row)
-            if castling_possible(board, src, Position(7, home_row), player_sign):
-                moves.append(Move(src, dst))
+        if sq == home_row * 8 + 4:
+            if castling_possible(board, sq, sq + 3, player_sign):
+                moves.append(sq | ((sq + 2) << 6))
 
-            dst = Position(2, home_row)
-            if castling_possible(board, src, Position(0, home_row), player_sign):
-                moves.append(Move(src, dst))
+            if castling_possible(board, sq, sq - 4, player_sign):
+                moves.append(sq | ((sq - 2) << 6))
 
     return moves
 
-def generate_moves(board: Board, player_sign: int, killer_moves: deque):
-    # Return a list of moves for the given board state and player
-    if player_sign not in [1, -1]:
-        raise ValueError("Player sign must be 1 or -1")
+def legal_masks(board: Board, player_sign: int):
+    # Work out once per node what legal moves must respect: the king's
+    # square, the squares other pieces may move to (all of them, or when in
+    # check capturing or blocking the checker, or none in double check) and
+    # the pieces pinned to the king
+    king_square = board.king_square(player_sign)
+    if king_square is None:
+        return None, FULL, 0
+
+    checkers = board.attackers(king_square, -player_sign)
+    if checkers == 0:
+        evasions = FULL
+    elif checkers & (checkers - 1) == 0:
+        evasions = checkers | between[king_square][checkers.bit_length() - 1]
+    else:
+        evasions = 0
+    return king_square, evasions, board.pinned(king_square, player_sign)
+
+def en_passant_legal(board: Board, move: int, king_square: int, player_sign: int):
+    # En passant takes two pieces off one rank, which the masks cannot
+    # describe, so play it out
+    unmove = board.move(move)
+    legal = not board.is_attacked(king_square, -player_sign)
+    board.unmove(unmove)
+    return legal
+
+def legal_moves_from(board: Board, sq: int, player_sign: int, masks):
+    # Legal moves of player_sign's piece on sq, given legal_masks
+    king_square, evasions, pinned = masks
+    if sq == king_square:
+        # King moves are checked against attacks as they are generated
+        return find_moves(board, sq)
+
+    target_mask = evasions
+    if pinned & (1 << sq):
+        target_mask &= line[king_square][sq]
+    moves = find_moves(board, sq, target_mask)
+    if board.squares[sq] * player_sign == 1 and king_square is not None:
+        squares = board.squares
+        moves = [
+            move for move in moves
+            if squares[(move >> 6) & 0x3F] != 0 or not (move ^ (move >> 6)) & 7 or
+            en_passant_legal(board, move, king_square, player_sign)
+        ]
+    return moves
 
-    moves: List[Move] = []
+def legal_moves(board: Board, player_sign: int, masks=None) -> List[int]:
+    # The legal moves for player_sign, unordered
+    if masks is None:
+        masks = legal_masks(board, player_sign)
+    moves: List[int] = []
+    for sq in squares_of(board.occupancy[player_sign]):
+        moves.extend(legal_moves_from(board, sq, player_sign, masks))
+    return moves
 
-    positions = board.find_piece_positions(player_sign)
-    king_position = None
-    for src in positions:
-        signed_piece = board[src]
+def is_legal(board: Board, move: int, player_sign: int, masks) -> bool:
+    # Check a move from elsewhere (the transposition table, a killer slot)
+    # against this position
+    src = move & 0x3F
+    if player_sign * board.squares[src] <= 0:
+        return False
+    return move in legal_moves_from(board, src, player_sign, masks)
 
-        if signed_piece * player_sign <= 0:
-            continue
+def is_quiet(board: Board, move: int) -> bool:
+    # Neither a capture nor a promotion
+    if move >> 14 == PROMOTION_FLAG or board.squares[(move >> 6) & 0x3F] != 0:
+        return False
+    # En passant is the one capture onto an empty square
+    return abs(board.squares[move & 0x3F]) != 1 or not (move ^ (move >> 6)) & 7
+
+def has_pieces(board: Board, player_sign: int) -> bool:
+    # Whether player_sign has anything besides pawns and the king
+    return board.occupancy[player_sign] & ~(board.bitboards[player_sign] | board.bitboards[6 * player_sign]) != 0
+
+def move_order_score(board: Board, move: int):
+    # Value of the piece that ends up on dst
+    if move >> 14 == PROMOTION_FLAG:
+        return move_order_values[((move >> 12) & 0x3) + 2]
+    return move_order_values[abs(board.squares[move & 0x3F])]
+
+def generate_moves(
+    board: Board, player_sign: int, killer_moves: deque, hash_move: int = 0,
+    history: List[List[int]] = None, counter_move: int = 0
+) -> array:
+    # Return the legal moves for the given board state and player, packed as
+    # by encode_move and best first. history is indexed by player sign and
+    # then the move's squares (move & 0xFFF), like AIGame.history.
+    if player_sign not in [1, -1]:
+        raise ValueError("Player sign must be 1 or -1")
 
-        if board[src] == player_sign * 6:
-            king_position = src
+    # Sort keys hold the ordering score above the move itself
+    keys = []
+    for move in legal_moves(board, player_sign):
+        score = move_order_score(board, move)
+        #score = player_sign * evaluate_position(board)
+        if history is not None:
+            score += history[player_sign][move & 0xFFF]
+        if move == counter_move:
+            score += counter_move_score
+        if move in killer_moves:
+            score += killer_move_score
+        if move == hash_move:
+            score += hash_move_score
+        keys.append((score << 16) | move)
+
+    keys.sort(reverse=True)
+    return array("H", [key & 0xFFFF for key in keys])
+
+def generate_captures(board: Board, player_sign: int, masks=None) -> array:
+    # Return the legal captures and queen promotions for player_sign, most
+    # valuable victim first and least valuable attacker first among equals
+    captures: List[int] = []
+    squares = board.squares
+    enemy = board.occupancy[-player_sign]
+    occupancy = board.occupancy[0]
+    last_row = 7 if player_sign == 1 else 0
+    en_passant_pos = board.en_passant_pos
+    king_square, evasions, pinned = masks if masks is not None else legal_masks(board, player_sign)
+
+    for src in squares_of(board.occupancy[player_sign]):
+        piece = abs(squares[src])
+        target_mask = evasions
+        if pinned & (1 << src):
+            target_mask &= line[king_square][src]
+
+        if piece == 1:
+            targets = pawn_attacks[player_sign][src] & enemy
+            push = src + 8 * player_sign
+            if push >> 3 == last_row and squares[push] == 0:
+                targets |= 1 << push
+            targets &= target_mask
+            if en_passant_pos is not None and en_passant_pos.y == src >> 3 and abs(en_passant_pos.x - (src & 7)) == 1:
+                dst = src + 8 * player_sign + en_passant_pos.x - (src & 7)
+                if king_square is None or en_passant_legal(board, src | (dst << 6), king_square, player_sign):
+                    targets |= 1 << dst
+
+            for dst in squares_of(targets):
+                if dst >> 3 == last_row:
+                    captures.append(src | (dst << 6) | (3 << 12) | (PROMOTION_FLAG << 14))
+                else:
+                    captures.append(src | (dst << 6))
+        elif piece == 2:
+            add_moves(captures, src, knight_attacks[src] & enemy & target_mask)
+        elif piece == 3:
+            add_moves(captures, src, bishop_tables[src][occupancy & bishop_masks[src]] & enemy & target_mask)
+        elif piece == 4:
+            add_moves(captures, src, rook_tables[src][occupancy & rook_masks[src]] & enemy & target_mask)
+        elif piece == 5:
+            add_moves(captures, src, (
+                bishop_tables[src][occupancy & bishop_masks[src]] |
+                rook_tables[src][occupancy & rook_masks[src]]
+            ) & enemy & target_mask)
+        elif piece == 6:
+            without_king = occupancy ^ (1 << src)
+            for dst in squares_of(king_attacks[src] & enemy):
+                if not board.is_attacked(dst, -player_sign, without_king):
+                    captures.append(src | (dst << 6))
+
+    keys = []
+    for move in captures:
+        victim = abs(squares[(move >> 6) & 0x3F])
+        if victim == 0 and move >> 14 != PROMOTION_FLAG:
+            # En passant
+            victim = 1
+        attacker = abs(squares[move & 0x3F])
+        keys.append(((10 * move_order_values[victim] - attacker) << 16) | move)
+
+    keys.sort(reverse=True)
+    return array("H", [key & 0xFFFF for key in keys])
+
+class MovePicker:
+    """The legal moves of one node, generated a stage at a time as the search
+    asks for them: the hash move, winning captures by MVV-LVA, killer moves
+    and the counter move, quiet moves by history score and last the losing
+    captures. A node that is cut off early never generates the later stages.
+
+    Moves are packed as by encode_move.
+    """
+    HASH, CAPTURES, KILLERS, QUIETS, LOSING_CAPTURES, DONE = range(6)
+
+    def __init__(
+        self, board: Board, player_sign: int, killer_moves=(), hash_move: int = 0,
+        history: List[List[int]] = None, counter_move: int = 0
+    ):
+        self.board = board
+        self.player_sign = player_sign
+        self.killer_moves = killer_moves
+        self.hash_move = hash_move
+        self.history = history
+        self.counter_move = counter_move
+        self.masks = None
+        self.losing_captures: List[int] = []
+        self.moves = array("H")
+        self.stage = self.HASH
+
+    def __getitem__(self, i):
+        return self.moves[i]
+
+    def __len__(self):
+        # The number of moves generated so far
+        return len(self.moves)
+
+    def exhausted(self, i: int) -> bool:
+        """Check whether there is no move i, generating more moves as needed."""
+        while i >= len(self.moves):
+            if self.stage == self.DONE:
+                return True
+            self.next_stage()
+        return False
 
-        moves.extend(find_moves(board, src))
-    
-    valid_moves = []
-    scores = []
-    if king_position is not None:
-        attacks = find_all_possible_attacks(board, king_position, -1 * player_sign)
-    else:
-        attacks = []
-    for move in moves:
-        unmove = board.move(move)
-        if move.src == king_position or king_position is None:
-            valid_move = True
-        else:
-            valid_move = True
-            for attacking_piece, attack_move in attacks:
-                if attacking_piece != board[attack_move.src]:
+    def stop(self):
+        """Generate no more moves, after a cutoff."""
+        self.stage = self.DONE
+
+    def next_stage(self):
+        board = self.board
+        player_sign = self.player_sign
+        moves = self.moves
+        if self.masks is None:
+            self.masks = legal_masks(board, player_sign)
+
+        stage = self.stage
+        self.stage += 1
+        if stage == self.HASH:
+            if self.hash_move != 0 and is_legal(board, self.hash_move, player_sign, self.masks):
+                moves.append(self.hash_move)
+        elif stage == self.CAPTURES:
+            squares = board.squares
+            for move in generate_captures(board, player_sign, self.masks):
+                if move == self.hash_move:
                     continue
-
-                if abs(attacking_piece) in [1, 2, 6]:
-                    valid_move = False
-                    break
+                # Without a static exchange evaluation, call a capture losing
+                # when the attacker is worth more than a defended victim
+                dst = (move >> 6) & 0x3F
+                victim = abs(squares[dst]) or 1
+                attacker = abs(squares[move & 0x3F])
+                if (
+                    move >> 14 != PROMOTION_FLAG and
+                    move_order_values[attacker] > move_order_values[victim] and
+                    board.is_attacked(dst, -player_sign)
+                ):
+                    self.losing_captures.append(move)
                 else:
-                    valid_move = False
-                    offset = attack_move.dst - attack_move.src
-                    if offset.x != 0 and offset.y != 0:
-                        dir = Position(1 if offset.x > 0 else -1, 1 if offset.y > 0 else -1)
-                        distance = offset.x
-
-                        for dist in range(1, distance):
-                            midpoint = attack_move.src + dist * dir
-
-                            if board.occupied(midpoint):
-                                valid_move = True
-                                break
-                    else:
-                        if offset.x == 0:
-                            dir = Position(0, 1 if offset.y > 0 else -1)
-                            distance = abs(offset.y)
-                        else:
-                            dir = Position(1 if offset.x > 0 else -1, 0)
-                            distance = abs(offset.x)
-
-                        for dist in range(1, distance):
-                            midpoint = attack_move.src + dist * dir
-
-                            if board.occupied(midpoint):
-                                valid_move = True
-                                break
-                
-                if not valid_move:
-                    break
+                    moves.append(move)
+        elif stage == self.KILLERS:
+            for move in list(self.killer_moves) + [self.counter_move]:
+                if (
+                    move != 0 and
+                    move not in moves and move not in self.losing_captures and
+                    is_legal(board, move, player_sign, self.masks)
+                ):
+                    moves.append(move)
+        elif stage == self.QUIETS:
+            done = set(moves)
+            done.update(self.losing_captures)
+            # By history score, then by the value of the piece moved
+            history = self.history[player_sign] if self.history is not None else 4096 * [0]
+            keys = [
+                (((history[move & 0xFFF] << 18) | move_order_score(board, move)) << 16) | move
+                for move in legal_moves(board, player_sign, self.masks) if move not in done
+            ]
+            keys.sort(reverse=True)
+            moves.extend([key & 0xFFFF for key in keys])
+        elif stage == self.LOSING_CAPTURES:
+            moves.extend(self.losing_captures)
+
+# Score of being checkmated at the root. Mates further away score closer to
+# zero by one per ply, and anything beyond mate_bound is a mate.
+mate_score = 1000000.0
+mate_bound = mate_score - 1000
+
+def mate_moves(score: float):
+    """Moves to mate for a score from the side to move's point of view,
+    negative when it is being mated, or None if the score is not a mate."""
+    if score > mate_bound:
+        return int(mate_score - score + 1) // 2
+    if score < -mate_bound:
+        return -int(mate_score + score) // 2
+    return None
 
-        if valid_move:
-            valid_moves.append(move)
-            score = 0
-            piece = abs(board[move.dst])
-            if piece != 0:
-                score += values[piece]
-            #score = player_sign * evaluate_position(board)
-            if move in killer_moves:
-                score += 1000
-            scores.append(score)
-        board.unmove(unmove)
-    
-    sorted_idx = numpy.argsort(scores)
-    return [valid_moves[idx] for idx in reversed(sorted_idx)]
-
-values = numpy.array([0.0, 100.0, 300.0, 320.0, 500.0, 900.0, 200000.0])
-
-position_bonus = numpy.array([
-    [0, 0, 0, 0, 0, 0, 0, 0],
-    [0, 0, 0, 0, 0, 0, 0, 0],
-    [0, 0, 10, 10, 10, 10, 0, 0],
-    [0, 0, 10, 30, 30, 10, 0, 0],
-    [0, 0, 10, 30, 30, 10, 0, 0],
-    [0, 0, 10, 10, 10, 10, 0, 0],
-    [0, 0, 0, 0, 0, 0, 0, 0],
-    [0, 0, 0, 0, 0, 0, 0, 0],
-])
+def score_to_tt(score: float, ply: int) -> float:
+    # The table keeps mate scores relative to the node, not the root
+    if score > mate_bound:
+        return score + ply
+    if score < -mate_bound:
+        return score - ply
+    return score
+
+def score_from_tt(score: float, ply: int) -> float:
+    if score > mate_bound:
+        return score - ply
+    if score < -mate_bound:
+        return score + ply
+    return score
+
+# Aspiration windows wider than this give way to a full window
+aspiration_limit = 2000.0
+
+# Ordering bonus for the transposition table's best move, enough to put it
+# ahead of every other move
+hash_move_score = 10000000
+killer_move_score = 1000
+counter_move_score = 500
+
+# Piece values as ints, for building move ordering sort keys
+move_order_values = [int(value) for value in values]
 
 piece_mobility_scores = {
     2 : 10.0,
@@ -344,166 +431,893 @@ piece_mobility_scores = {
     6 : 0.0
 }
 
+# Score of a position the bitbases say is won, below the mate scores. Wins
+# are told apart by material and position bonus, by how far a pawn has
+# advanced, and by how far the losing king has been driven to the edge and
+# towards the winning one, which is what steers the search to the mate.
+bitbase_win_score = 10000.0
+
+def bitbase_score(board: Board, result: int, player_sign: int) -> float:
+    # Score of a bitbase result (1 won, 0 drawn, -1 lost for player_sign)
+    # from player_sign's point of view
+    if result == 0:
+        return 0.0
+    strong_sign = result * player_sign
+    strong_king = board.king_square(strong_sign)
+    weak_king = board.king_square(-strong_sign)
+    x, y = weak_king & 7, weak_king >> 3
+    edge = max(3 - x, x - 4) + max(3 - y, y - 4)
+    distance = abs(x - (strong_king & 7)) + abs(y - (strong_king >> 3))
+    score = bitbase_win_score + strong_sign * board.score + 50 * edge + 20 * (14 - distance)
+    pawn = board.bitboards[strong_sign]
+    if pawn:
+        rank = (pawn.bit_length() - 1) >> 3
+        score += 50 * (rank if strong_sign == 1 else 7 - rank)
+    return result * score
+
 def evaluate_position(board):
-    # Return score of current board
-    total_value = 0.0
-
-    for sign in [1, -1]:
-        # Create a board where the pieces of the side we're considering are positive
-        positive_perspective_board = board.board * sign
-        pieces = positive_perspective_board[positive_perspective_board > 0]
-        
-        # positions = board.find_piece_positions(sign)
-        # for pos in positions:
-        #     piece = abs(board[pos])
-        #     if piece > 1:
-        #         total_value += sign * piece_mobility_scores[piece] * len(find_moves(board, pos))
-
-        total_value += sign * (
-            numpy.sum(values[pieces]) +
-            numpy.sum(position_bonus * (positive_perspective_board > 0))
-        )
-    
+    # Return score of current board. Board keeps the material and position
+    # bonus totals up to date as it moves (see Board.score), and likewise the
+    # accumulator of a learned evaluator if it has one.
+    if board.accumulator is not None:
+        return board.evaluator.evaluate(board.accumulator)
+    total_value = board.score
+
+    # positions = board.find_piece_positions(sign)
+    # for pos in positions:
+    #     piece = abs(board[pos])
+    #     if piece > 1:
+    #         total_value += sign * piece_mobility_scores[piece] * len(find_moves(board, pos))
+
     return total_value
 
+def evaluation_fingerprint(evaluator=None, bitbases=None) -> int:
+    """Identify the evaluation search scores come from: the learned
+    evaluator's weights, if any, and whether bitbases are probed. A
+    persistent TranspositionTable is only reused with the same one."""
+    digest = hashlib.blake2b(digest_size=8)
+    if evaluator is not None:
+        digest.update(evaluator.data)
+    digest.update(b"bitbases" if bitbases is not None else b"")
+    return int.from_bytes(digest.digest(), "little")
+
+class TimedMovePicker(MovePicker):
+    # A MovePicker that adds the time it spends generating to stats
+    def __init__(self, stats: "SearchStats", *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.stats = stats
+
+    def next_stage(self):
+        start = time.perf_counter()
+        super().next_stage()
+        self.stats.movegen_time += time.perf_counter() - start
+
+@dataclass
+class SearchStats:
+    # What a search did, filled in while it runs when AIGame.collect_stats is
+    # set. The per depth lists have an entry for every completed iteration
+    # of iterative deepening.
+    nodes_per_depth: List[int] = field(default_factory=list)
+    # Nodes where the main search reached depth 0 and handed over to the
+    # quiescence search
+    leaves_per_depth: List[int] = field(default_factory=list)
+    # Seconds each iteration took
+    time_per_depth: List[float] = field(default_factory=list)
+    leaves: int = 0
+    # Beta cutoffs in the main search, and how many of them the first move
+    # searched caused
+    cutoffs: int = 0
+    first_move_cutoffs: int = 0
+    tt_probes: int = 0
+    tt_hits: int = 0
+    # Seconds spent generating moves (MovePicker and quiescence captures)
+    # and evaluating positions
+    movegen_time: float = 0.0
+    eval_time: float = 0.0
+
+    @property
+    def first_move_cutoff_rate(self) -> float:
+        return self.first_move_cutoffs / self.cutoffs if self.cutoffs > 0 else 0.0
+
+    @property
+    def tt_hit_rate(self) -> float:
+        return self.tt_hits / self.tt_probes if self.tt_probes > 0 else 0.0
+
+    @property
+    def effective_branching_factor(self) -> List[float]:
+        """Nodes of each iteration over the nodes of the one before."""
+        nodes = self.nodes_per_depth
+        return [nodes[d] / nodes[d - 1] if nodes[d - 1] > 0 else 0.0 for d in range(1, len(nodes))]
+
+    @property
+    def nps_per_depth(self) -> List[float]:
+        return [
+            nodes / seconds if seconds > 0 else 0.0
+            for nodes, seconds in zip(self.nodes_per_depth, self.time_per_depth)
+        ]
+
+    def as_dict(self) -> dict:
+        """The counters and the rates worked out from them."""
+        return dict(
+            self.__dict__,
+            first_move_cutoff_rate=self.first_move_cutoff_rate,
+            tt_hit_rate=self.tt_hit_rate,
+            effective_branching_factor=self.effective_branching_factor,
+            nps_per_depth=self.nps_per_depth,
+        )
+
+    # Timed stand-ins for what the search calls, swapped in by AIGame
+    def evaluate(self, board: Board) -> float:
+        start = time.perf_counter()
+        score = evaluate_position(board)
+        self.eval_time += time.perf_counter() - start
+        return score
+
+    def generate_captures(self, board: Board, player_sign: int) -> array:
+        start = time.perf_counter()
+        captures = generate_captures(board, player_sign)
+        self.movegen_time += time.perf_counter() - start
+        return captures
+
+    def move_picker(self, *args, **kwargs) -> MovePicker:
+        return TimedMovePicker(self, *args, **kwargs)
+
+@dataclass(frozen=True)
+class SearchInfo:
+    # Result of one completed iteration of iterative deepening
+    depth: int
+    # Positive when white is ahead
+    score: float
+    pv: List[Move]
+    nodes: int
+    # Seconds since the search started
+    time: float
+    # The statistics so far, if the search collects them
+    stats: SearchStats = None
+
+class SearchStopped(Exception):
+    pass
 
 class AIGame:
     board: Board
+    tt: TranspositionTable
     dmax: int = 5
     killer_move_count: int = 2
-
-    def __init__(self, board_: Board):
+    tt_size_mb: float = 16
+    # Captures that cannot bring the score within this margin of alpha are
+    # skipped in the quiescence search
+    delta_margin: float = 200.0
+    # Half width of the first aspiration window around the last score
+    aspiration_window: float = 50.0
+    # Selective search, each part switchable on its own. Null move pruning
+    # searches a pass null_move_reduction plies shallower. Late move
+    # reductions take a ply (two deep in the tree) off quiet moves after the
+    # first lmr_min_moves, from lmr_min_depth up. Futility pruning skips
+    # quiet moves at depth d when the static score plus futility_margins[d - 1]
+    # is no better than alpha.
+    null_move: bool = True
+    null_move_reduction: int = 2
+    late_move_reductions: bool = True
+    lmr_min_depth: int = 3
+    lmr_min_moves: int = 3
+    futility_pruning: bool = True
+    futility_margins: Tuple[float, ...] = (200.0, 500.0)
+    # Worker processes used by pick_next_move_parallel (None for one per CPU)
+    workers: int = None
+    # Search limits. When one runs out, or stop() is called, pick_next_move
+    # returns the best move of the last completed iteration. A time limit
+    # also keeps a new iteration from starting once half of it is used.
+    time_limit: float = None
+    node_limit: int = None
+    # The node limit is checked on every node, the clock and stop() every
+    # check_interval nodes (a power of two)
+    check_interval: int = 1024
+    # Called with a SearchInfo after every completed iteration
+    on_iteration: Callable[[SearchInfo], None] = None
+    # Fill in a SearchStats (self.stats) during every search. The search
+    # then calls timed versions of the move generation and evaluation, and
+    # does not otherwise do more than a few counts when this is off.
+    collect_stats: bool = False
+    stats: SearchStats = None
+    # Opening book (see book.OpeningBook) played from before searching
+    book = None
+    # Endgame bitbases (see bitbase.Bitbases) probed during the search
+    bitbases = None
+    # Principal continuation and its score (positive when white is ahead)
+    # from the last search, and the nodes it visited
+    pv: List[Move]
+    score: float
+    nodes: int
+    # Move ordering tables kept between searches, indexed by player sign and
+    # then the move's squares (move & 0xFFF). history counts the cutoffs of
+    # quiet moves, weighted by depth, and counter_moves holds the quiet move
+    # that last refuted each move of the other player.
+    history: List[List[int]]
+    counter_moves: List[List[int]]
+    # History scores are halved at the start of every search, and whenever
+    # one passes history_limit
+    history_limit: int = 1 << 20
+
+    def __init__(self, board_: Board, tt: TranspositionTable = None):
         self.board = board_
-
-    def update_position(self, move: Move, clist: List[Unmove], ply: int):
-        # Update the board with a new move
+        # Pass in a table to share search results between games
+        self.tt = tt if tt is not None else TranspositionTable(self.tt_size_mb)
+        self.pv = []
+        self.score = 0.0
+        self.nodes = 0
+        self.reset()
+        self.stop_event = threading.Event()
+        self.start_time = time.perf_counter()
+        self.set_stats(None)
+        # XORed into board.key for the table, so entries are keyed by the
+        # side to move even when a search is not for the side the board's
+        # key expects
+        self.key_correction = 0
+        # Worker processes for pick_next_move_parallel, started on first use
+        # (see search_pool)
+        self.pool = None
+
+    def reset(self):
+        """Forget the move ordering learned by earlier searches, so the next
+        one only depends on the transposition table."""
+        self.history = [[], 4096 * [0], 4096 * [0]]
+        self.counter_moves = [[], 4096 * [0], 4096 * [0]]
+        self.killer_moves = [deque() for ply in range(self.dmax + 1)]
+
+    def set_stats(self, stats: SearchStats):
+        # Start collecting into stats, or stop collecting if it is None
+        self.stats = stats
+        if stats is None:
+            self.evaluate = evaluate_position
+            self.generate_captures = generate_captures
+            self.move_picker = MovePicker
+        else:
+            self.evaluate = stats.evaluate
+            self.generate_captures = stats.generate_captures
+            self.move_picker = stats.move_picker
+
+    def __getstate__(self):
+        # The stop event, callback, book and worker pool stay behind when a
+        # game is sent to a worker process
+        state = dict(self.__dict__)
+        del state["stop_event"]
+        state.pop("on_iteration", None)
+        state.pop("book", None)
+        for name in ["pool", "pool_settings", "pool_searches", "worker_stop_event", "worker_progress"]:
+            state.pop(name, None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.stop_event = threading.Event()
+        self.pool = None
+
+    def stop(self):
+        """Stop a running search (from another thread). Searches do not clear
+        the stop event, so whoever starts one clears it first."""
+        self.stop_event.set()
+
+    def check_limits(self):
+        # Raise SearchStopped if the search is out of time or nodes, or was stopped
+        if self.stop_event.is_set():
+            raise SearchStopped()
+        if self.node_limit is not None and self.nodes >= self.node_limit:
+            raise SearchStopped()
+        if self.time_limit is not None and time.perf_counter() - self.start_time >= self.time_limit:
+            raise SearchStopped()
+
+    def age_history(self):
+        for player_sign in [1, -1]:
+            self.history[player_sign] = [score >> 1 for score in self.history[player_sign]]
+
+    def record_cutoff(self, move: int, prev_move: int, ply: int, depth: int, player_sign: int):
+        # Remember a move that cut off a node for ordering. Only quiet moves
+        # are kept, captures are ordered well enough by MVV-LVA.
+        if not is_quiet(self.board, move):
+            return
+
+        killer_moves = self.killer_moves[ply]
+        if move not in killer_moves:
+            if len(killer_moves) >= self.killer_move_count:
+                killer_moves.popleft()
+            killer_moves.append(move)
+
+        history = self.history[player_sign]
+        history[move & 0xFFF] += depth * depth
+        if history[move & 0xFFF] > self.history_limit:
+            self.age_history()
+
+        if prev_move != 0:
+            self.counter_moves[player_sign][prev_move & 0xFFF] = move
+
+    def make_move(self, move: int) -> Unmove:
+        # Play a move in the search, counting the node
         unmove = self.board.move(move)
-        clist.append(unmove)
-        return ply + 1
-
-    def restore_position(self, clist : List[Unmove], ply : int):
-        # Pop a board change off the clist to return the board to a previous state
-        unmove = clist.pop()
-        self.board.unmove(unmove)
-        return ply - 1
-
-    def pc_update(self, mptr, moves, scores, pc, ply, player_sign):
-        # Update the principle continuation for ply - 1
-        if ply == 0:
-            return False
-
-        if player_sign == 1:
-            # Odd plies minimize, even plies maximize
-            if (ply - 1) % 2 == 0:
-                do_update = scores[ply] > scores[ply - 1]
-            else:
-                do_update = scores[ply] < scores[ply - 1]
+        self.nodes += 1
+        # nodes only counts up by one, so it meets node_limit exactly
+        if self.nodes & (self.check_interval - 1) == 0 or self.nodes == self.node_limit:
+            try:
+                self.check_limits()
+            except SearchStopped:
+                self.board.unmove(unmove)
+                raise
+        return unmove
+
+    def tt_probe(self, depth: int, ply: int, alpha: float, beta: float):
+        # Look up the position, returning (score or None if the entry does
+        # not settle the node, hash move)
+        entry = self.tt.probe(self.board.key ^ self.key_correction)
+        if self.stats is not None:
+            self.stats.tt_probes += 1
+            self.stats.tt_hits += entry is not None
+        if entry is None:
+            return None, 0
+        stored_depth, score, bound, move = entry
+        if stored_depth < depth:
+            return None, move
+        score = score_from_tt(score, ply)
+        if bound == EXACT or (bound == LOWER and score >= beta) or (bound == UPPER and score <= alpha):
+            return score, move
+        return None, move
+
+    def tt_store(self, depth: int, ply: int, score: float, alpha: float, beta: float, move: int):
+        # alpha and beta are the window the node was searched with
+        if score >= beta:
+            bound = LOWER
+        elif score <= alpha:
+            bound = UPPER
+            move = 0
         else:
-            # Invert the logic for other player
-            if (ply - 1) % 2 == 0:
-                do_update = scores[ply] < scores[ply - 1]
-            else:
-                do_update = scores[ply] > scores[ply - 1]
-        
-        if ply > 1:
-            if player_sign == 1:
-                if (ply - 1) % 2 == 0:
-                    do_prune = scores[ply] >= scores[ply - 2]
-                else:
-                    do_prune = scores[ply] <= scores[ply - 2]
-            else:
-                if (ply - 1) % 2 == 0:
-                    do_prune = scores[ply] <= scores[ply - 2]
-                else:
-                    do_prune = scores[ply] >= scores[ply - 2]
+            bound = EXACT
+        self.tt.store(self.board.key ^ self.key_correction, depth, round(score_to_tt(score, ply)), bound, move)
+
+    def quiescence(self, player_sign, alpha, beta, ply: int):
+        # Search captures and promotions until the position is quiet. Scores
+        # are from player_sign's point of view. In check there is no standing
+        # pat, every evasion is searched instead.
+        board = self.board
+        king_square = board.king_square(player_sign)
+        in_check = king_square is not None and board.is_attacked(king_square, -player_sign)
+        if in_check:
+            # Captures first, in their usual order, then the other evasions
+            captures = self.generate_captures(board, player_sign)
+            moves = list(captures) + [move for move in legal_moves(board, player_sign) if move not in captures]
+            if len(moves) == 0:
+                return -mate_score + ply
+            stand_pat = -float('inf')
         else:
-            do_prune = False
+            stand_pat = player_sign * self.evaluate(board)
+            if stand_pat >= beta:
+                return stand_pat
+            if stand_pat > alpha:
+                alpha = stand_pat
+            moves = self.generate_captures(board, player_sign)
+
+        for move in moves:
+            # Delta pruning
+            if not in_check and move >> 14 != PROMOTION_FLAG:
+                victim = abs(board.squares[(move >> 6) & 0x3F])
+                if stand_pat + values[victim if victim != 0 else 1] + self.delta_margin <= alpha:
+                    continue
+
+            unmove = board.move(move)
+            self.nodes += 1
+            try:
+                if self.nodes & (self.check_interval - 1) == 0 or self.nodes == self.node_limit:
+                    self.check_limits()
+                score = -self.quiescence(-player_sign, -beta, -alpha, ply + 1)
+            finally:
+                board.unmove(unmove)
 
-        if do_update:
-            scores[ply - 1] = scores[ply]
-            if ply < len(pc):
-                current_pc = pc[ply]
+            if score >= beta:
+                return score
+            if score > alpha:
+                alpha = score
+
+        return alpha
+
+    def negamax(self, depth: int, ply: int, alpha: float, beta: float, player_sign: int, prev_move: int, pv: List[int]):
+        # Search the position to depth plies with a fail-soft alpha-beta,
+        # returning its score from player_sign's point of view. The principal
+        # variation found is written into pv. prev_move is 0 after a null move.
+        board = self.board
+        result = None
+        if self.bitbases is not None:
+            # Known draws end here, and known wins at the horizon. Wins are
+            # still searched above it (and in check), so the search finds its
+            # way to the mate.
+            result = self.bitbases.probe(board, player_sign)
+            if result is not None and (result == 0 or depth <= 0):
+                king_square = board.king_square(player_sign)
+                if not board.is_attacked(king_square, -player_sign):
+                    pv.clear()
+                    return bitbase_score(board, result, player_sign)
+
+        if depth <= 0:
+            if self.stats is not None:
+                self.stats.leaves += 1
+            return self.quiescence(player_sign, alpha, beta, ply)
+
+        score, hash_move = self.tt_probe(depth, ply, alpha, beta)
+        if score is not None:
+            return score
+
+        king_square = board.king_square(player_sign)
+        in_check = king_square is not None and board.is_attacked(king_square, -player_sign)
+        child_pv: List[int] = []
+
+        futile = False
+        if not in_check and abs(beta) < mate_bound:
+            if result is None:
+                static_score = player_sign * self.evaluate(board)
             else:
-                current_pc = []
-            pc[ply - 1] = [moves[ply - 1][mptr[ply - 1]]] + current_pc
-
-        return do_prune
-
-    def pick_next_move(self, active_player_sign : int):
-        moves: List[List[Move]] = self.dmax * [[]]
-        killer_moves: List[Deque[Move]] = self.dmax * [deque()]
-        mptr: List[int] = self.dmax * [0]
-        scores: List[float] = (self.dmax + 1) * [0]
-        pc: List[List[Move]] = self.dmax * [[]]
-        clist: List[Unmove] = []
-        ply: int = 0
-        player_sign: int = active_player_sign
+                static_score = bitbase_score(board, result, player_sign)
 
-        for current_dmax in range(1, self.dmax + 1):
-            moves[ply] = generate_moves(self.board, player_sign, killer_moves[ply])
-            mptr[ply] = 0
-            scores[ply] = player_sign * -float('inf')
-            while ply < len(pc[0]):
-                next_move = pc[0][ply]
+            # Null move pruning: if passing still fails high, a real move would
+            # too. Not with only pawns left, where passing can be the best
+            # move (zugzwang), and never twice in a row.
+            if (
+                self.null_move and prev_move != 0 and depth > self.null_move_reduction and
+                static_score >= beta and has_pieces(board, player_sign)
+            ):
+                unmove = board.null_move()
+                try:
+                    score = -self.negamax(
+                        depth - 1 - self.null_move_reduction, ply + 1, -beta, -beta + 1, -player_sign, 0, child_pv
+                    )
+                finally:
+                    board.unmove(unmove)
+                if score >= beta:
+                    return beta
+
+            # Futility pruning: near the leaves, quiet moves cannot lift a
+            # score this far below alpha
+            futile = (
+                self.futility_pruning and depth <= len(self.futility_margins) and
+                static_score + self.futility_margins[depth - 1] <= alpha
+            )
+
+        moves = self.move_picker(
+            board, player_sign, self.killer_moves[ply], hash_move, history=self.history,
+            counter_move=self.counter_moves[player_sign][prev_move & 0xFFF] if prev_move != 0 else 0
+        )
+        original_alpha = alpha
+        best_score = -float('inf')
+        best_move = 0
+        i = 0
+        while not moves.exhausted(i):
+            move = moves[i]
+            i += 1
+            quiet = is_quiet(board, move)
+            reducible = (
+                self.late_move_reductions and quiet and not in_check and depth >= self.lmr_min_depth and
+                i > self.lmr_min_moves and move not in self.killer_moves[ply]
+            )
+            child_pv.clear()
+            unmove = self.make_move(move)
+            try:
+                gives_check = False
+                if (futile or reducible) and quiet:
+                    enemy_king = board.king_square(-player_sign)
+                    gives_check = enemy_king is not None and board.is_attacked(enemy_king, player_sign)
+                if futile and quiet and i > 1 and not gives_check:
+                    best_score = max(best_score, static_score + self.futility_margins[depth - 1])
+                    continue
 
-                moves[ply].remove(next_move)
-                moves[ply] = [next_move] + moves[ply]
+                if i == 1:
+                    score = -self.negamax(depth - 1, ply + 1, -beta, -alpha, -player_sign, move, child_pv)
+                else:
+                    # Late move reductions: quiet moves far down the list are
+                    # searched less deep first
+                    reduction = 0
+                    if reducible and not gives_check:
+                        reduction = 2 if depth >= 6 and i > 3 * self.lmr_min_moves else 1
+
+                    # Principal variation search: prove the move is no better
+                    # with a zero window, and search it properly only if it is
+                    score = -self.negamax(depth - 1 - reduction, ply + 1, -alpha - 1, -alpha, -player_sign, move, child_pv)
+                    if reduction > 0 and score > alpha:
+                        child_pv.clear()
+                        score = -self.negamax(depth - 1, ply + 1, -alpha - 1, -alpha, -player_sign, move, child_pv)
+                    if alpha < score < beta:
+                        child_pv.clear()
+                        score = -self.negamax(depth - 1, ply + 1, -beta, -alpha, -player_sign, move, child_pv)
+            finally:
+                board.unmove(unmove)
 
-                ply = self.update_position(next_move, clist, ply)
+            if score > best_score:
+                best_score = score
+                best_move = move
+                if score > alpha:
+                    pv[:] = [move] + child_pv
+                    if score >= beta:
+                        self.record_cutoff(move, prev_move, ply, depth, player_sign)
+                        if self.stats is not None:
+                            self.stats.cutoffs += 1
+                            self.stats.first_move_cutoffs += i == 1
+                        moves.stop()
+                        break
+                    alpha = score
 
-                moves[ply] = generate_moves(self.board, player_sign * (-1)**ply, killer_moves[ply])
-                mptr[ply] = 0
-                if len(moves[ply]) == 0:
-                    scores[ply] = evaluate_position(self.board)
-                elif ply > 1:
-                    scores[ply] = scores[ply - 2]
+        if i == 0:
+            # Checkmate or stalemate
+            if in_check:
+                best_score = -mate_score + ply
+            else:
+                best_score = 0.0
+            pv.clear()
+            self.tt.store(board.key ^ self.key_correction, depth, round(score_to_tt(best_score, ply)), EXACT, 0)
+            return best_score
+
+        self.tt_store(depth, ply, best_score, original_alpha, beta, best_move)
+        return best_score
+
+    def search_root(self, root: array, depth: int, alpha: float, beta: float, player_sign: int, pv: List[int]):
+        # Like negamax, for the root moves given in order. root_best keeps the
+        # best line found so far, in case the search is stopped.
+        best_score = -float('inf')
+        child_pv: List[int] = []
+        for i, move in enumerate(root):
+            child_pv.clear()
+            unmove = self.make_move(move)
+            try:
+                if i == 0:
+                    score = -self.negamax(depth - 1, 1, -beta, -alpha, -player_sign, move, child_pv)
                 else:
-                    scores[ply] = player_sign * (-1)**ply * -float('inf')
+                    score = -self.negamax(depth - 1, 1, -alpha - 1, -alpha, -player_sign, move, child_pv)
+                    if alpha < score < beta:
+                        child_pv.clear()
+                        score = -self.negamax(depth - 1, 1, -beta, -alpha, -player_sign, move, child_pv)
+            finally:
+                self.board.unmove(unmove)
+
+            if score > best_score:
+                best_score = score
+                if score > alpha:
+                    pv[:] = [move] + child_pv
+                    self.root_best = (pv[:], score)
+                    if score >= beta:
+                        break
+                    alpha = score
+        return best_score
 
-            while True:
-                if mptr[ply] == len(moves[ply]):
-                    prune = self.pc_update(mptr, moves, scores, pc, ply, player_sign)
+    def book_move(self, player_sign: int) -> Move:
+        # Play from the book while the position is in it
+        if self.book is None:
+            return None
+        move = self.book.pick(self.board, player_sign)
+        if move is not None:
+            self.pv = [move]
+            self.score = evaluate_position(self.board)
+            self.nodes = 0
+        return move
+
+    def extend_pv(self, pv: List[Move], player_sign: int) -> List[Move]:
+        """pv followed by the table's hash moves from where it ends, up to
+        dmax moves in all. Cutoffs on table entries leave the PV short, most
+        of all with a persistent table, and this fills it back in. pv starts
+        with player_sign to move on the board."""
+        board = self.board
+        correction = board.side_key_correction(player_sign)
+        unmoves = [board.move(encode_move(move)) for move in pv]
+        pv = list(pv)
+        sign = player_sign if len(pv) % 2 == 0 else -player_sign
+        seen = {board.key}
+        try:
+            while len(pv) < self.dmax:
+                entry = self.tt.probe(board.key ^ correction)
+                if entry is None or entry[3] == 0 or entry[3] not in legal_moves(board, sign):
+                    break
+                pv.append(decode_move(entry[3]))
+                unmoves.append(board.move(entry[3]))
+                sign = -sign
+                # Stop at a repetition, the line would only go round
+                if board.key in seen:
+                    break
+                seen.add(board.key)
+        finally:
+            for unmove in reversed(unmoves):
+                board.unmove(unmove)
+        return pv
+
+    def pick_next_move(self, active_player_sign : int, root_moves: List[int] = None, start_time: float = None):
+        # Iterative deepening over negamax, with an aspiration window around
+        # the last iteration's score. root_moves restricts the search to some
+        # of the moves at the root. start_time (from time.perf_counter) starts
+        # the clock before the call, so the workers of a parallel search keep
+        # its deadline. Moves are packed (see board.encode_move) until the
+        # result is returned.
+        player_sign: int = active_player_sign
+        self.set_stats(SearchStats() if self.collect_stats else None)
+        stats = self.stats
+        if root_moves is None:
+            move = self.book_move(player_sign)
+            if move is not None:
+                return move
+
+        self.killer_moves = [deque() for ply in range(self.dmax + 1)]
+        self.root_best = None
+        self.key_correction = self.board.side_key_correction(player_sign)
+
+        self.tt.new_search()
+        self.age_history()
+        self.start_time = start_time if start_time is not None else time.perf_counter()
+        self.nodes = 0
+        best_pv: List[int] = None
+        # Scores are from the point of view of player_sign until the end
+        best_score: float = player_sign * evaluate_position(self.board)
+
+        entry = self.tt.probe(self.board.key ^ self.key_correction)
+        hash_move = entry[3] if entry is not None else 0
+        root = generate_moves(self.board, player_sign, deque(), hash_move, self.history)
+        if root_moves is not None:
+            root = array("H", [move for move in root if move in root_moves])
+
+        if len(root) == 0:
+            king_square = self.board.king_square(player_sign)
+            if king_square is not None and self.board.is_attacked(king_square, -player_sign):
+                best_score = -mate_score
+            elif root_moves is None:
+                best_score = 0.0
+            best_pv = []
+
+        try:
+            for current_dmax in range(1, self.dmax + 1 if len(root) > 0 else 1):
+                if (
+                    current_dmax > 1 and self.time_limit is not None and
+                    time.perf_counter() - self.start_time > self.time_limit / 2
+                ):
+                    # The next iteration would likely not finish in time
+                    break
 
-                    if ply == 0:
+                # Search the last iteration's best move first
+                if best_pv:
+                    root.remove(best_pv[0])
+                    root.insert(0, best_pv[0])
+
+                pv: List[int] = []
+                iteration_start = (self.nodes, stats.leaves, time.perf_counter()) if stats is not None else None
+                window = self.aspiration_window
+                if current_dmax > 1 and abs(best_score) < mate_bound:
+                    alpha = best_score - window
+                    beta = best_score + window
+                else:
+                    alpha = -float('inf')
+                    beta = float('inf')
+                while True:
+                    score = self.search_root(root, current_dmax, alpha, beta, player_sign, pv)
+                    # Widen the window on the side the score fell outside of
+                    if score <= alpha:
+                        window *= 4
+                        alpha = score - window if window < aspiration_limit else -float('inf')
+                    elif score >= beta:
+                        window *= 4
+                        beta = score + window if window < aspiration_limit else float('inf')
+                    else:
                         break
 
-                    ply = self.restore_position(clist, ply)
-                    if prune:
-                        if len(killer_moves[ply]) >= self.killer_move_count:
-                            killer_moves[ply].popleft()
-                        killer_moves[ply].append(moves[ply][mptr[ply]])
-                        mptr[ply] = len(moves[ply]) # skip the rest of the moves
-                    else:
-                        mptr[ply] += 1
+                if root_moves is None:
+                    self.tt_store(current_dmax, 0, score, alpha, beta, pv[0])
+
+                # The iteration finished, so its result can be trusted
+                best_pv = pv
+                best_score = score
+                if stats is not None:
+                    nodes, leaves, start = iteration_start
+                    stats.nodes_per_depth.append(self.nodes - nodes)
+                    stats.leaves_per_depth.append(stats.leaves - leaves)
+                    stats.time_per_depth.append(time.perf_counter() - start)
+                if self.on_iteration is not None:
+                    self.on_iteration(SearchInfo(
+                        current_dmax, player_sign * best_score, [decode_move(move) for move in best_pv], self.nodes,
+                        time.perf_counter() - self.start_time, stats
+                    ))
+        except SearchStopped:
+            if best_pv is None:
+                # Stopped during the first iteration, so make do with the best
+                # root move searched so far, or else the first one in order
+                if self.root_best is not None:
+                    best_pv, best_score = self.root_best
                 else:
-                    next_move = moves[ply][mptr[ply]]
-                    ply = self.update_position(next_move, clist, ply)
-                    if ply < current_dmax:
-                        # If not at last layer, advance layer
-                        moves[ply] = generate_moves(self.board, player_sign * (-1)**ply, killer_moves[ply])
-                        mptr[ply] = 0
-                        if len(moves[ply]) == 0:
-                            scores[ply] = evaluate_position(self.board)
-                        elif ply > 1:
-                            scores[ply] = scores[ply - 2]
-                        else:
-                            scores[ply] = player_sign * (-1)**ply * -float('inf')
-                    elif ply == current_dmax:
-                        # If at last layer, evaluate score
-                        scores[ply] = evaluate_position(self.board)
-                        prune = self.pc_update(mptr, moves, scores, pc, ply, player_sign)
-                        ply = self.restore_position(clist, ply)
-                        if prune:
-                            if len(killer_moves[ply]) >= self.killer_move_count:
-                                killer_moves[ply].popleft()
-                            killer_moves[ply].append(next_move)
-                            mptr[ply] = len(moves[ply]) # skip the rest of the moves
-                        else:
-                            mptr[ply] += 1
-                    else:
-                        raise Exception("Unhandled state")
+                    best_pv = list(root[:1])
 
-        if len(pc[0]) > 0:
-            return pc[0][0]
+        self.pv = [decode_move(move) for move in best_pv] if best_pv is not None else []
+        self.score = player_sign * best_score
+        if len(self.pv) > 0:
+            return self.pv[0]
         else:
             return None
+
+    def pick_next_move_with_stats(self, active_player_sign: int) -> Tuple[Move, SearchStats]:
+        """Search like pick_next_move, collecting statistics whatever
+        collect_stats says, and return them with the move."""
+        collect_stats = self.collect_stats
+        self.collect_stats = True
+        try:
+            move = self.pick_next_move(active_player_sign)
+        finally:
+            self.collect_stats = collect_stats
+        return move, self.stats
+
+    def report_iterations(self, iterations: dict, reported: int, root_moves: array, workers: int, player_sign: int) -> int:
+        # Pass each depth after reported that all workers have finished to
+        # on_iteration, as one SearchInfo with the best of their scores and
+        # PVs and the sum of their nodes. iterations maps depth to worker
+        # index to SearchInfo. Returns the last depth reported.
+        for depth in sorted(iterations):
+            infos = iterations[depth]
+            if depth <= reported:
+                continue
+            if len(infos) < workers:
+                break
+            # Ties go to the move ordered first, as in the final choice
+            best = max(infos.values(), key=lambda info: (
+                player_sign * info.score, -root_moves.index(encode_move(info.pv[0]))
+            ))
+            self.on_iteration(SearchInfo(
+                depth, best.score, best.pv, sum(info.nodes for info in infos.values()),
+                time.perf_counter() - self.start_time
+            ))
+            reported = depth
+        return reported
+
+    def search_pool(self) -> concurrent.futures.ProcessPoolExecutor:
+        # The worker processes for pick_next_move_parallel, with the event
+        # that stops them and the queue they send their iterations to.
+        # Starting them takes a while, so they are kept between searches,
+        # and only replaced when the number of workers, the table or the
+        # bitbases they were given change.
+        settings = (self.workers or os.cpu_count() or 1, self.tt, self.bitbases)
+        if self.pool is not None and all(a is b for a, b in zip(settings, self.pool_settings)):
+            return self.pool
+        self.close()
+        # Both can only reach the workers when they start, not with a task
+        self.worker_stop_event = _search_context.Event()
+        self.worker_progress = _search_context.Queue()
+        self.pool = concurrent.futures.ProcessPoolExecutor(
+            max_workers=settings[0], mp_context=_search_context, initializer=_init_search_worker,
+            initargs=(self, self.worker_stop_event, self.worker_progress)
+        )
+        self.pool_settings = settings
+        self.pool_searches = 0
+        return self.pool
+
+    def close(self):
+        """Shut down the worker processes of parallel searches, if any."""
+        if self.pool is not None:
+            self.pool.shutdown()
+            self.worker_progress.close()
+            self.pool = None
+
+    def pick_next_move_parallel(self, active_player_sign : int):
+        # Split the root moves between worker processes. Each worker searches
+        # its share with pick_next_move, and all of them share one
+        # transposition table, so work on transposed positions is not repeated.
+        # on_iteration is called here once all workers finish a depth. Workers
+        # import the main module, so a script calling this needs the usual
+        # if __name__ == "__main__" guard.
+        self.start_time = time.perf_counter()
+        move = self.book_move(active_player_sign)
+        if move is not None:
+            return move
+
+        if self.tt.shared_array is None and self.tt.path is None:
+            # Same number of entries as the table it replaces. A file-backed
+            # table is shared through the file already.
+            size_mb = len(self.tt) * TranspositionTable.entry_size / (1 << 20)
+            self.tt = TranspositionTable(size_mb, shared=True)
+
+        entry = self.tt.probe(self.board.key ^ self.board.side_key_correction(active_player_sign))
+        hash_move = entry[3] if entry is not None else 0
+        root_moves = generate_moves(self.board, active_player_sign, deque(), hash_move)
+        if len(root_moves) == 0:
+            self.pv = []
+            self.score = evaluate_position(self.board)
+            return None
+
+        executor = self.search_pool()
+        workers = min(self.pool_settings[0], len(root_moves))
+        # Deal the moves out in order so every worker gets some of the likely
+        # best ones
+        shares = [root_moves[i::workers] for i in range(workers)]
+
+        # stop() only reaches this process, so pass it on to the workers.
+        # The workers of the last search are done with the event by now.
+        self.worker_stop_event.clear()
+        # The queue outlives each search, so iterations are tagged with the
+        # search they belong to, and ones sent too late for the last search
+        # are dropped. Workers only send them if there is someone to report
+        # them to.
+        self.pool_searches += 1
+        search = self.pool_searches if self.on_iteration is not None else None
+        limits = (self.dmax, self.time_limit, self.node_limit)
+        iterations = {}
+        reported = 0
+        futures = [
+            executor.submit(
+                _search_root_moves, self.board, active_player_sign, share, index, limits, self.start_time, search
+            )
+            for index, share in enumerate(shares)
+        ]
+        while not all(future.done() for future in futures):
+            concurrent.futures.wait(futures, timeout=0.05)
+            if self.stop_event.is_set():
+                self.worker_stop_event.set()
+            if search is not None:
+                while True:
+                    try:
+                        info_search, index, info = self.worker_progress.get_nowait()
+                    except queue.Empty:
+                        break
+                    if info_search == search:
+                        iterations.setdefault(info.depth, {})[index] = info
+                reported = self.report_iterations(iterations, reported, root_moves, workers, active_player_sign)
+        results = [future.result() for future in futures]
+
+        self.nodes = sum(nodes for move, score, pv, nodes, infos in results)
+        if search is not None:
+            # The queue can lag behind the results, which hold every
+            # worker's iterations too
+            for index, (move, score, pv, nodes, infos) in enumerate(results):
+                for info in infos:
+                    iterations.setdefault(info.depth, {})[index] = info
+            self.report_iterations(iterations, reported, root_moves, workers, active_player_sign)
+
+        best_move = None
+        best_order = len(root_moves)
+        for move, score, pv, nodes, infos in results:
+            if move is None:
+                continue
+            # Break ties in favour of the move ordered first
+            order = root_moves.index(encode_move(move))
+            if (
+                best_move is None or
+                active_player_sign * score > active_player_sign * self.score or
+                (score == self.score and order < best_order)
+            ):
+                best_move = move
+                best_order = order
+                self.score = score
+                self.pv = pv
+
+        return best_move
+
+# Search workers are not forked, as a fork copies locks held by other threads
+# (like a UCI engine's stdin reader) into the worker, locked for good
+_search_context = multiprocessing.get_context(
+    "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+)
+
+# The AIGame each search worker process reuses, set up by
+# _init_search_worker, and the queue it sends its iterations to
+_worker_game: AIGame = None
+_worker_progress = None
+
+def _init_search_worker(game: AIGame, stop_event, progress):
+    global _worker_game, _worker_progress
+    _worker_game = game
+    _worker_game.stop_event = stop_event
+    # The parent reports for all workers together (a forked worker would
+    # otherwise inherit its callback)
+    _worker_game.on_iteration = None
+    _worker_progress = progress
+
+def _search_root_moves(
+    board: Board, player_sign: int, root_moves: List[int], index: int, limits: Tuple[int, float, int],
+    start_time: float, search: int
+):
+    # Search root_moves with the parent's limits and clock. search tags the
+    # iterations sent to the parent, or is None if none are wanted.
+    game = _worker_game
+    game.board = board
+    game.dmax, game.time_limit, game.node_limit = limits
+    infos = []
+    if search is not None:
+        def on_iteration(info: SearchInfo):
+            info = replace(info, stats=None)
+            infos.append(info)
+            _worker_progress.put((search, index, info))
+        game.on_iteration = on_iteration
+    move = game.pick_next_move(player_sign, root_moves, start_time)
+    game.on_iteration = None
+    return move, game.score, game.pv, game.nodes, infos
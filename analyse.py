@@ -0,0 +1,173 @@
+import argparse
+import concurrent.futures
+import json
+import os
+import sys
+import time
+from collections import deque
+from typing import Iterable, Iterator, Optional, Tuple
+from ai import AIGame, evaluation_fingerprint, mate_moves
+from bitbase import Bitbases
+from nnue import LinearEvaluator
+from board import Board, move_name
+from transposition import TranspositionTable
+
+def read_positions(lines: Iterable[str]) -> Iterator[Tuple[int, str, Optional[str]]]:
+    """Yield (line number, fen, id) for every position in a FEN or EPD file.
+
+    EPD lines have the four position fields of a FEN followed by operations
+    like bm Nf3; id "test 1";. Only the id is kept. Blank lines and lines
+    starting with # are skipped.
+    """
+    for number, line in enumerate(lines, 1):
+        line = line.strip()
+        if len(line) == 0 or line.startswith("#"):
+            continue
+        fields = line.split(None, 4)
+        position = fields[:4]
+        rest = fields[4] if len(fields) > 4 else ""
+
+        rest_fields = rest.split()
+        if len(rest_fields) >= 2 and rest_fields[0].isdigit() and rest_fields[1].isdigit():
+            # Plain FEN with move counters
+            yield number, " ".join(position + rest_fields[:2]), None
+            continue
+
+        position_id = None
+        for operation in rest.split(";"):
+            operation = operation.strip()
+            if operation.startswith("id "):
+                position_id = operation[3:].strip().strip('"')
+        yield number, " ".join(position), position_id
+
+# The AIGame each analysis worker process reuses, set up by _init_worker
+_worker_game: AIGame = None
+
+def _init_worker(
+    depth: int, movetime: Optional[float], nodes: Optional[int], tt_size_mb: float, bitbases: Optional[str],
+    cache: Optional[str], stats: bool, evaluator: Optional[str]
+):
+    global _worker_game
+    evaluator = LinearEvaluator(evaluator) if evaluator is not None else None
+    bitbases = Bitbases(bitbases) if bitbases is not None else None
+    tt = TranspositionTable(tt_size_mb, path=cache, fingerprint=evaluation_fingerprint(evaluator, bitbases))
+    _worker_game = AIGame(Board(), tt)
+    _worker_game.dmax = depth
+    _worker_game.time_limit = movetime
+    _worker_game.node_limit = nodes
+    _worker_game.bitbases = bitbases
+    _worker_game.collect_stats = stats
+    if evaluator is not None:
+        _worker_game.board.set_evaluator(evaluator)
+
+def analyse_position(number: int, fen: str, position_id: Optional[str]) -> dict:
+    """Search one position with the worker's AIGame and describe the result."""
+    result = {"line": number, "fen": fen}
+    if position_id is not None:
+        result["id"] = position_id
+
+    game = _worker_game
+    try:
+        player_sign = game.board.set_fen(fen)
+    except ValueError as e:
+        result["error"] = str(e)
+        return result
+
+    # Start every position from an empty table and fresh move ordering, so
+    # results do not depend on which worker searched what before. A cache
+    # file is there to be reused, so it is kept.
+    if game.tt.path is None:
+        game.tt.clear()
+    game.reset()
+    start = time.perf_counter()
+    move = game.pick_next_move(player_sign)
+    elapsed = time.perf_counter() - start
+
+    result["bestmove"] = move_name(move) if move is not None else None
+    # Like UCI, the score is from the point of view of the side to move, and
+    # mates are given in moves instead
+    mate = mate_moves(player_sign * game.score)
+    if mate is not None:
+        result["mate"] = mate
+    else:
+        result["score"] = round(player_sign * game.score)
+    result["pv"] = [move_name(pv_move) for pv_move in game.extend_pv(game.pv, player_sign)]
+    result["nodes"] = game.nodes
+    result["time"] = round(elapsed, 3)
+    if game.stats is not None:
+        result["stats"] = game.stats.as_dict()
+    return result
+
+def analyse(
+    lines: Iterable[str], out, depth: int = AIGame.dmax, movetime: float = None,
+    nodes: int = None, workers: int = None, tt_size_mb: float = 16, bitbases: str = None,
+    cache: str = None, stats: bool = False, evaluator: str = None
+) -> int:
+    """Analyse every position in lines, writing one JSON line each to out.
+
+    Results come out in input order. Only a few positions per worker are in
+    flight at once, so memory stays bounded however long the input is. With
+    a cache file all workers share one persistent transposition table (see
+    TranspositionTable), kept for the next run. With stats every result
+    also holds the search statistics (see SearchStats). Returns the number
+    of positions written.
+    """
+    workers = workers or os.cpu_count() or 1
+    max_pending = 2 * workers
+    written = 0
+    if cache is not None:
+        # Create the file once, before the workers race to, and check it was
+        # made with this evaluation
+        fingerprint = evaluation_fingerprint(LinearEvaluator(evaluator) if evaluator is not None else None, bitbases)
+        TranspositionTable(tt_size_mb, path=cache, fingerprint=fingerprint)
+    with concurrent.futures.ProcessPoolExecutor(
+        max_workers=workers, initializer=_init_worker, initargs=(depth, movetime, nodes, tt_size_mb, bitbases, cache, stats, evaluator)
+    ) as executor:
+        pending = deque()
+        for position in read_positions(lines):
+            pending.append(executor.submit(analyse_position, *position))
+            if len(pending) >= max_pending:
+                print(json.dumps(pending.popleft().result()), file=out, flush=True)
+                written += 1
+        while len(pending) > 0:
+            print(json.dumps(pending.popleft().result()), file=out, flush=True)
+            written += 1
+    return written
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Analyse the positions of a FEN or EPD file, writing JSON lines.")
+    parser.add_argument("input", help="FEN or EPD file, one position per line (- for stdin)")
+    parser.add_argument("-o", "--output", default="-", help="JSON lines file to write (- for stdout)")
+    parser.add_argument("--depth", type=int, default=AIGame.dmax, help="search depth per position")
+    parser.add_argument("--movetime", type=float, help="seconds per position")
+    parser.add_argument("--nodes", type=int, help="nodes per position")
+    parser.add_argument("--workers", type=int, help="worker processes (default one per CPU)")
+    parser.add_argument("--hash", type=float, default=16, help="transposition table size per worker in MB")
+    parser.add_argument("--bitbases", help="directory of endgame bitbases (see bitbase.py)")
+    parser.add_argument("--cache", help="transposition table file kept between runs (created at --hash MB)")
+    parser.add_argument("--stats", action="store_true", help="add search statistics to every result")
+    parser.add_argument("--evaluator", help="learned evaluator weights (see nnue.py)")
+    args = parser.parse_args(argv)
+
+    infile = sys.stdin if args.input == "-" else open(args.input)
+    outfile = sys.stdout if args.output == "-" else open(args.output, "w")
+    try:
+        start = time.perf_counter()
+        try:
+            count = analyse(
+                infile, outfile, args.depth, args.movetime, args.nodes, args.workers, args.hash, args.bitbases,
+                args.cache, args.stats, args.evaluator
+            )
+        except ValueError as e:
+            # A cache file that does not fit
+            parser.error(str(e))
+        print(f"analysed {count} positions in {time.perf_counter() - start:.2f}s", file=sys.stderr)
+    finally:
+        if infile is not sys.stdin:
+            infile.close()
+        if outfile is not sys.stdout:
+            outfile.close()
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
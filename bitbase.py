@@ -0,0 +1,180 @@
+import argparse
+import mmap
+import os
+import sys
+import time
+from typing import Dict
+import numpy
+from ai import legal_moves
+from bitboard import king_attacks
+from board import Board, castling_squares
+
+# Win/draw bitbases for king and one piece against a lone king, worked out by
+# retrograde analysis over Board's own move rules. The weak side cannot win
+# these, so one bit per position says whether the strong side does.
+#
+# Positions are seen with the strong side as white, and indexed by
+# side << 18 | strong king << 12 | weak king << 6 | piece square, with side 0
+# when the strong side is to move and 1 when the weak side is. Bits are
+# packed high bit first (numpy.packbits), 64 KB per file.
+
+# Strong piece of each material set, in the order they are generated, since
+# KPK looks up its promotions in KQK and KRK
+material_sets = {"KQK": 5, "KRK": 4, "KPK": 1}
+
+bitbase_size = 1 << 19
+
+def bitbase_index(side: int, strong_king: int, weak_king: int, piece_sq: int) -> int:
+    return side << 18 | strong_king << 12 | weak_king << 6 | piece_sq
+
+def generate(piece: int, promotions: Dict[int, numpy.ndarray] = None) -> numpy.ndarray:
+    """Work out which positions the strong side wins with piece, as a bool
+    array by bitbase_index. promotions holds the finished bitbases of the
+    pieces a pawn can promote to; other promotions count as draws."""
+    promotions = promotions or {}
+    # Successors of every position by index, in compressed rows. Index
+    # bitbase_size stands for a drawn and bitbase_size + 1 for a won
+    # position outside this bitbase.
+    draw, won = bitbase_size, bitbase_size + 1
+    starts = numpy.zeros(bitbase_size, dtype=numpy.int64)
+    counts = numpy.zeros(bitbase_size, dtype=numpy.int64)
+    successors = []
+    wins = numpy.zeros(bitbase_size + 2, dtype=bool)
+    wins[won] = True
+
+    board = Board()
+    board.set_board(numpy.zeros([8, 8], dtype=int))
+    # No castling, whatever squares the kings and rook stand on
+    board._has_moved = castling_squares
+    placed = []
+    for index in range(bitbase_size):
+        side, strong_king, weak_king, piece_sq = index >> 18, (index >> 12) & 63, (index >> 6) & 63, index & 63
+        starts[index] = len(successors)
+        if (
+            strong_king == weak_king or piece_sq == strong_king or piece_sq == weak_king or
+            king_attacks[strong_king] & (1 << weak_king) or (piece == 1 and (piece_sq < 8 or piece_sq >= 56))
+        ):
+            continue
+
+        for sq in placed:
+            board._clear(sq)
+        board._put(6, strong_king)
+        board._put(-6, weak_king)
+        board._put(piece, piece_sq)
+        placed = [strong_king, weak_king, piece_sq]
+        # The side not to move cannot be in check
+        if side == 0 and board.is_attacked(weak_king, 1):
+            continue
+
+        player_sign = 1 if side == 0 else -1
+        moves = legal_moves(board, player_sign)
+        if len(moves) == 0:
+            # Checkmate (only the weak side can be mated) or stalemate
+            wins[index] = side == 1 and board.is_attacked(weak_king, 1)
+            continue
+
+        for move in moves:
+            src, dst = move & 0x3F, (move >> 6) & 0x3F
+            if side == 1:
+                # The weak king either takes the piece or steps
+                successors.append(draw if dst == piece_sq else bitbase_index(0, strong_king, dst, piece_sq))
+            elif src == strong_king:
+                successors.append(bitbase_index(1, dst, weak_king, piece_sq))
+            elif move >> 14:
+                promoted = promotions.get(((move >> 12) & 0x3) + 2)
+                promoted_win = promoted is not None and promoted[bitbase_index(1, strong_king, weak_king, dst)]
+                successors.append(won if promoted_win else draw)
+            else:
+                successors.append(bitbase_index(1, strong_king, weak_king, dst))
+        counts[index] = len(moves)
+
+    # The strong side wins if any move wins, the weak side loses if every
+    # move loses. Repeat until nothing changes.
+    successors = numpy.array(successors, dtype=numpy.int64)
+    movable = numpy.nonzero(counts)[0]
+    segments = starts[movable]
+    strong_to_move = movable < (1 << 18)
+    while True:
+        results = wins[successors]
+        any_win = numpy.logical_or.reduceat(results, segments)
+        all_win = numpy.logical_and.reduceat(results, segments)
+        new_wins = numpy.where(strong_to_move, any_win, all_win)
+        if numpy.array_equal(new_wins, wins[movable]):
+            break
+        wins[movable] = new_wins
+    return wins[:bitbase_size]
+
+class Bitbases:
+    """The bitbases found in a directory, as written by main, memory-mapped
+    and probed bit by bit. Material sets without a file are not probed."""
+    def __init__(self, directory: str):
+        self.directory = directory
+        self.files = []
+        self.tables: Dict[int, mmap.mmap] = {}
+        for name, piece in material_sets.items():
+            path = os.path.join(directory, f"{name}.bin")
+            if os.path.exists(path):
+                f = open(path, "rb")
+                self.files.append(f)
+                self.tables[piece] = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def __getstate__(self):
+        # Only the directory goes to worker processes, which open whichever
+        # bitbases they find there themselves
+        return {"directory": self.directory}
+
+    def __setstate__(self, state):
+        self.__init__(state["directory"])
+
+    def close(self):
+        for table in self.tables.values():
+            table.close()
+        for f in self.files:
+            f.close()
+        self.tables = {}
+        self.files = []
+
+    def probe(self, board: Board, player_sign: int):
+        """1 if player_sign wins, 0 for a draw and -1 if it loses, or None
+        when there is no bitbase for the position."""
+        occupancy = board.occupancy[0]
+        kings = board.bitboards[6] | board.bitboards[-6]
+        others = occupancy & ~kings
+        if others == 0 or others & (others - 1) or occupancy.bit_count() != 3:
+            return None
+        piece_sq = others.bit_length() - 1
+        piece = board.squares[piece_sq]
+        table = self.tables.get(abs(piece))
+        if table is None:
+            return None
+
+        strong_sign = 1 if piece > 0 else -1
+        strong_king = board.king_square(strong_sign)
+        weak_king = board.king_square(-strong_sign)
+        if strong_sign == -1:
+            # Mirror the ranks so the strong side is white
+            strong_king, weak_king, piece_sq = strong_king ^ 56, weak_king ^ 56, piece_sq ^ 56
+        side = 0 if player_sign == strong_sign else 1
+        index = bitbase_index(side, strong_king, weak_king, piece_sq)
+        if not table[index >> 3] >> (7 - (index & 7)) & 1:
+            return 0
+        return 1 if side == 0 else -1
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Generate the endgame bitbases.")
+    parser.add_argument("directory", nargs="?", default="bitbases", help="directory to write the bitbases to")
+    args = parser.parse_args(argv)
+
+    os.makedirs(args.directory, exist_ok=True)
+    generated = {}
+    for name, piece in material_sets.items():
+        start = time.perf_counter()
+        wins = generate(piece, generated)
+        generated[piece] = wins
+        with open(os.path.join(args.directory, f"{name}.bin"), "wb") as f:
+            f.write(numpy.packbits(wins).tobytes())
+        print(f"{name}: {int(wins.sum())} won positions in {time.perf_counter() - start:.1f}s", file=sys.stderr)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,143 @@
+from typing import List
+
+# Squares are numbered y * 8 + x, so bit (y * 8 + x) of a bitboard is the
+# same bit Board.pos_bit hands out for Position(x, y).
+FULL = 0xFFFFFFFFFFFFFFFF
+
+rook_steps = ((1, 0), (-1, 0), (0, 1), (0, -1))
+bishop_steps = ((1, 1), (-1, 1), (1, -1), (-1, -1))
+knight_steps = (
+    (1, 2), (-1, 2), (2, -1), (2, 1),
+    (1, -2), (-1, -2), (-2, -1), (-2, 1)
+)
+king_steps = rook_steps + bishop_steps
+
+
+def on_board(x, y):
+    return 0 <= x < 8 and 0 <= y < 8
+
+
+def step_attacks(sq, steps):
+    x, y = sq % 8, sq // 8
+    attacks = 0
+    for dx, dy in steps:
+        if on_board(x + dx, y + dy):
+            attacks |= 1 << ((y + dy) * 8 + x + dx)
+    return attacks
+
+
+def slide_attacks(sq, steps, occupancy):
+    # Walk each ray until it runs off the board or hits a piece (the blocker
+    # itself is attacked)
+    x, y = sq % 8, sq // 8
+    attacks = 0
+    for dx, dy in steps:
+        tx, ty = x + dx, y + dy
+        while on_board(tx, ty):
+            bit = 1 << (ty * 8 + tx)
+            attacks |= bit
+            if occupancy & bit:
+                break
+            tx, ty = tx + dx, ty + dy
+    return attacks
+
+
+def relevant_mask(sq, steps):
+    # The squares whose occupancy can change the slider's attacks. The last
+    # square on each ray never blocks anything behind it, so it is left out.
+    x, y = sq % 8, sq // 8
+    mask = 0
+    for dx, dy in steps:
+        tx, ty = x + dx, y + dy
+        while on_board(tx + dx, ty + dy):
+            mask |= 1 << (ty * 8 + tx)
+            tx, ty = tx + dx, ty + dy
+    return mask
+
+
+def build_slider_table(steps):
+    """Build the masks and per-square lookups for one slider type.
+
+    This is the dictionary version of a PEXT lookup: the masked occupancy
+    itself is the key, so no magic multipliers are needed.
+    """
+    masks = []
+    tables = []
+    for sq in range(64):
+        mask = relevant_mask(sq, steps)
+        table = {}
+        # Enumerate every subset of the mask (carry-rippler)
+        subset = 0
+        while True:
+            table[subset] = slide_attacks(sq, steps, subset)
+            subset = (subset - mask) & mask
+            if subset == 0:
+                break
+        masks.append(mask)
+        tables.append(table)
+    return masks, tables
+
+
+knight_attacks: List[int] = [step_attacks(sq, knight_steps) for sq in range(64)]
+king_attacks: List[int] = [step_attacks(sq, king_steps) for sq in range(64)]
+
+# pawn_attacks[player_sign][sq] is the set of squares a pawn of player_sign on
+# sq attacks. Indexing with -1 picks the last entry, so black lives at [2].
+pawn_attacks: List[List[int]] = [
+    [],
+    [step_attacks(sq, ((1, 1), (-1, 1))) for sq in range(64)],
+    [step_attacks(sq, ((1, -1), (-1, -1))) for sq in range(64)],
+]
+
+rook_masks, rook_tables = build_slider_table(rook_steps)
+bishop_masks, bishop_tables = build_slider_table(bishop_steps)
+
+
+def squares_of(bb: int) -> List[int]:
+    """List the square numbers of the bits set in bb, lowest first."""
+    squares = []
+    while bb:
+        low = bb & -bb
+        squares.append(low.bit_length() - 1)
+        bb ^= low
+    return squares
+
+
+def ray_squares(sq, step):
+    # The squares from sq along step to the edge of the board, nearest first
+    x, y = sq % 8, sq // 8
+    dx, dy = step
+    squares = []
+    tx, ty = x + dx, y + dy
+    while on_board(tx, ty):
+        squares.append(ty * 8 + tx)
+        tx, ty = tx + dx, ty + dy
+    return squares
+
+
+# rays[sq][d] lists the squares along king_steps[d] from sq, nearest first.
+# Only squares on the board are included, so walking one needs no checks.
+rays: List[List[List[int]]] = [[ray_squares(sq, step) for step in king_steps] for sq in range(64)]
+
+
+def build_line_tables():
+    # between[a][b] holds the squares strictly between a and b and line[a][b]
+    # the whole line through them, edge to edge. Both are 0 unless a and b
+    # share a rank, file or diagonal.
+    between = [64 * [0] for sq in range(64)]
+    line = [64 * [0] for sq in range(64)]
+    for sq in range(64):
+        for d, (dx, dy) in enumerate(king_steps):
+            opposite = king_steps.index((-dx, -dy))
+            full = (1 << sq)
+            for target in rays[sq][d] + rays[sq][opposite]:
+                full |= 1 << target
+            mask = 0
+            for target in rays[sq][d]:
+                between[sq][target] = mask
+                line[sq][target] = full
+                mask |= 1 << target
+    return between, line
+
+
+between, line = build_line_tables()
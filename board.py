@@ -1,7 +1,12 @@
 from dataclasses import dataclass
 import copy
+import random
 import numpy
-from typing import List, Dict, Set
+from typing import List, Dict
+from bitboard import (
+    pawn_attacks, knight_attacks, king_attacks,
+    rook_tables, rook_masks, bishop_tables, bishop_masks, squares_of, between
+)
 
 @dataclass(frozen=True)
 class Position:
@@ -51,20 +56,170 @@ class Move:
 class PromotionMove(Move):
     promoted_piece: int
 
+# square_positions[y * 8 + x] is Position(x, y), so square numbers can be
+# turned back into positions without allocating
+square_positions = tuple(Position(sq % 8, sq // 8) for sq in range(64))
+
+# Moves pack into 16 bits as src square (bits 0-5), dst square (6-11), the
+# promoted piece type minus 2 (12-13) and a flag (14-15). 0 means no move.
+# The search, Board.move and the transposition table all work on packed
+# moves; Move and PromotionMove are for the UI and other callers.
+PROMOTION_FLAG = 1
+
+def encode_move(move: Move) -> int:
+    src = move.src.y * 8 + move.src.x
+    dst = move.dst.y * 8 + move.dst.x
+    if isinstance(move, PromotionMove):
+        return src | (dst << 6) | ((abs(move.promoted_piece) - 2) << 12) | (PROMOTION_FLAG << 14)
+    return src | (dst << 6)
+
+def decode_move(move: int) -> Move:
+    src = square_positions[move & 0x3F]
+    dst = square_positions[(move >> 6) & 0x3F]
+    if move >> 14 == PROMOTION_FLAG:
+        # Promotions on the last rank are white's, on the first black's
+        player_sign = 1 if dst.y == 7 else -1
+        return PromotionMove(src, dst, player_sign * (((move >> 12) & 0x3) + 2))
+    return Move(src, dst)
+
+def position_name(pos: Position) -> str:
+    """Name a position in algebraic notation, e.g. Position(4, 1) is e2."""
+    return "abcdefgh"[pos.x] + str(pos.y + 1)
+
+def move_name(move: Move) -> str:
+    """Name a move in UCI notation, e.g. e2e4 or e7e8q."""
+    name = position_name(move.src) + position_name(move.dst)
+    if isinstance(move, PromotionMove):
+        name += " pnbrqk"[abs(move.promoted_piece)]
+    return name
+
+def parse_position(name: str) -> Position:
+    """Parse a position in algebraic notation (see position_name)."""
+    if len(name) != 2 or name[0] not in "abcdefgh" or name[1] not in "12345678":
+        raise ValueError(f"Bad square {name}")
+    return Position("abcdefgh".index(name[0]), int(name[1]) - 1)
+
+def parse_move(name: str) -> Move:
+    """Parse a move in UCI notation (see move_name)."""
+    if len(name) not in [4, 5]:
+        raise ValueError(f"Bad move {name}")
+    src = parse_position(name[0:2])
+    dst = parse_position(name[2:4])
+    if len(name) == 5:
+        if name[4] not in "nbrq":
+            raise ValueError(f"Bad promotion in move {name}")
+        # Promotions on the last rank are white's, on the first black's
+        player_sign = 1 if dst.y == 7 else -1
+        return PromotionMove(src, dst, player_sign * " pnbrqk".index(name[4]))
+    return Move(src, dst)
+
 @dataclass(frozen = True)
 class Unmove:
-    removes: List[PiecePosition]
-    adds: List[PiecePosition]
+    # The board's lists as they were before the move. Board.move works on
+    # fresh copies, so undoing a move only has to put these back.
+    squares: List[int]
+    bitboards: List[int]
+    occupancy: List[int]
     en_passant_pos: Position
     has_moved: int
+    key: int
+    score: float
+    accumulator: numpy.ndarray
+
+# Zobrist keys. The seed is fixed so every process (and every run) agrees on
+# the key of a position. piece_keys is indexed like Board.bitboards, by signed
+# piece and then square.
+_zobrist_random = random.Random(0x5EED)
+piece_keys = [[_zobrist_random.getrandbits(64) for sq in range(64)] for piece in range(13)]
+piece_keys[0] = 64 * [0]
+castling_keys = [_zobrist_random.getrandbits(64) for rights in range(16)]
+en_passant_keys = [_zobrist_random.getrandbits(64) for x in range(8)]
+side_key = _zobrist_random.getrandbits(64)
+
+# The squares whose _has_moved bits decide castling rights
+castling_squares = (1 << 0) | (1 << 4) | (1 << 7) | (1 << 56) | (1 << 60) | (1 << 63)
+
+values = numpy.array([0.0, 100.0, 300.0, 320.0, 500.0, 900.0, 200000.0])
+
+position_bonus = numpy.array([
+    [0, 0, 0, 0, 0, 0, 0, 0],
+    [0, 0, 0, 0, 0, 0, 0, 0],
+    [0, 0, 10, 10, 10, 10, 0, 0],
+    [0, 0, 10, 30, 30, 10, 0, 0],
+    [0, 0, 10, 30, 30, 10, 0, 0],
+    [0, 0, 10, 10, 10, 10, 0, 0],
+    [0, 0, 0, 0, 0, 0, 0, 0],
+    [0, 0, 0, 0, 0, 0, 0, 0],
+])
+
+# piece_square_scores[piece][sq] is what a signed piece on sq adds to
+# Board.score: its value plus its position bonus, negated for black. It is
+# indexed like Board.bitboards.
+piece_square_scores = [64 * [0.0] for piece in range(13)]
+for sq in range(64):
+    for piece in range(1, 7):
+        piece_square_scores[piece][sq] = float(values[piece] + position_bonus[sq // 8, sq % 8])
+        piece_square_scores[-piece][sq] = -piece_square_scores[piece][sq]
+del sq, piece
+
+start_fen = "rnbqkbnr/pppppppp/8/8/8/8/PPPPPPPP/RNBQKBNR w KQkq - 0 1"
+
+fen_pieces = {
+    "P": 1, "N": 2, "B": 3, "R": 4, "Q": 5, "K": 6,
+    "p": -1, "n": -2, "b": -3, "r": -4, "q": -5, "k": -6
+}
+
+# The king and rook squares each FEN castling right depends on
+fen_castling_squares = {
+    "K": (1 << 4) | (1 << 7),
+    "Q": (1 << 4) | (1 << 0),
+    "k": (1 << 60) | (1 << 63),
+    "q": (1 << 60) | (1 << 56),
+}
+
+def castling_rights(has_moved: int):
+    """Pack the castling rights left by a _has_moved mask into four bits:
+    white king side, white queen side, black king side, black queen side."""
+    rights = 0
+    if not has_moved & (1 << 4):
+        if not has_moved & (1 << 7):
+            rights |= 1
+        if not has_moved & (1 << 0):
+            rights |= 2
+    if not has_moved & (1 << 60):
+        if not has_moved & (1 << 63):
+            rights |= 4
+        if not has_moved & (1 << 56):
+            rights |= 8
+    return rights
 
 class Board:
-    board: numpy.array = numpy.zeros([8, 8]).astype(int)
+    # squares is a mailbox of signed pieces indexed by y * 8 + x. bitboards
+    # and occupancy mirror it: bitboards[piece] holds the squares of a signed
+    # piece and occupancy[player_sign] the squares of one player, with
+    # occupancy[0] for both. Negative indices wrap around, which is what lets
+    # black use the same lookups as white.
+    squares: List[int]
+    bitboards: List[int]
+    occupancy: List[int]
     # en_passant_pos stores the en passant position
     # so for e2e4, the en_passant_pos would be e3
     en_passant_pos: Position = None
     _has_moved: int = 0
-    pos_bit: Dict[Position, int] = {}
+    # Zobrist key of the position, including the side to move. Board.move
+    # flips the side, so the key assumes the players alternate (see
+    # side_key_correction for when they do not).
+    key: int = 0
+    # Material plus position bonus, positive when white is ahead. Kept up to
+    # date by Board.move so evaluation does not have to scan the board.
+    score: float = 0.0
+    # Optional learned evaluator (see nnue.LinearEvaluator) and its
+    # accumulator for the position, kept up to date the same way. Moves
+    # replace the accumulator rather than change it, so Unmove can keep the
+    # old one.
+    evaluator = None
+    accumulator: numpy.ndarray = None
+    pos_bit: Dict[Position, int] = {pos: 1 << sq for sq, pos in enumerate(square_positions)}
 
     def __init__(self):
         self.reset()
@@ -81,64 +236,288 @@ class Board:
             [-4, -2, -3, -5, -6, -3, -2, -4]
         ]).astype(int)
 
-        self.board = board
+        self.set_board(board)
         self.en_passant_pos = None
         self._has_moved = 0
+        self.key = self.compute_key()
+
+    def copy(self):
+        """Return an independent copy of the board."""
+        board = copy.copy(self)
+        board.squares = self.squares[:]
+        board.bitboards = self.bitboards[:]
+        board.occupancy = self.occupancy[:]
+        return board
+
+    @property
+    def board(self) -> numpy.array:
+        """The position as an 8x8 array indexed [y, x]. Writes to it are not
+        reflected back on the board; use set_board for that."""
+        return numpy.array(self.squares).reshape(8, 8)
+
+    def set_board(self, board: numpy.array):
+        self.squares = 64 * [0]
+        self.bitboards = 13 * [0]
+        self.occupancy = 3 * [0]
+        self.key = 0
+        self.score = 0.0
+        if self.evaluator is not None:
+            self.accumulator = self.evaluator.bias
+        for sq, piece in enumerate(numpy.asarray(board).flatten()):
+            if piece != 0:
+                self._put(int(piece), sq)
+
+    def _put(self, piece: int, sq: int):
+        # Place piece on an empty square
+        self.squares[sq] = piece
+        if piece != 0:
+            bit = 1 << sq
+            self.bitboards[piece] |= bit
+            self.occupancy[1 if piece > 0 else -1] |= bit
+            self.occupancy[0] |= bit
+            self.key ^= piece_keys[piece][sq]
+            self.score += piece_square_scores[piece][sq]
+            if self.accumulator is not None:
+                self.accumulator = self.accumulator + self.evaluator.piece_weights[piece][sq]
+
+    def _clear(self, sq: int):
+        piece = self.squares[sq]
+        if piece != 0:
+            bit = 1 << sq
+            self.bitboards[piece] ^= bit
+            self.occupancy[1 if piece > 0 else -1] ^= bit
+            self.occupancy[0] ^= bit
+            self.key ^= piece_keys[piece][sq]
+            self.score -= piece_square_scores[piece][sq]
+            if self.accumulator is not None:
+                self.accumulator = self.accumulator - self.evaluator.piece_weights[piece][sq]
+            self.squares[sq] = 0
+
+    def set_fen(self, fen: str) -> int:
+        """Load a position from FEN, returning the sign of the player to move.
+
+        The halfmove and fullmove counters are accepted but ignored.
+        """
+        fields = fen.split()
+        if len(fields) < 2:
+            raise ValueError(f"FEN needs at least a board and a side to move: {fen}")
+
+        ranks = fields[0].split("/")
+        if len(ranks) != 8:
+            raise ValueError(f"FEN board must have 8 ranks: {fen}")
+
+        board = numpy.zeros([8, 8]).astype(int)
+        for i, rank in enumerate(ranks):
+            y = 7 - i
+            x = 0
+            for c in rank:
+                if c.isdigit():
+                    x += int(c)
+                elif c in fen_pieces and x < 8:
+                    board[y, x] = fen_pieces[c]
+                    x += 1
+                else:
+                    raise ValueError(f"Bad FEN rank {rank}: {fen}")
+            if x != 8:
+                raise ValueError(f"Bad FEN rank {rank}: {fen}")
+
+        if fields[1] not in ["w", "b"]:
+            raise ValueError(f"Bad FEN side to move {fields[1]}: {fen}")
+        player_sign = 1 if fields[1] == "w" else -1
+
+        # Everything counts as moved except the squares a castling right needs
+        has_moved = castling_squares
+        castling = fields[2] if len(fields) > 2 else "-"
+        for c in castling:
+            if c in fen_castling_squares:
+                has_moved &= ~fen_castling_squares[c]
+            elif c != "-":
+                raise ValueError(f"Bad FEN castling rights {castling}: {fen}")
+
+        # FEN names the square behind the pawn, en_passant_pos is the pawn
+        en_passant_pos = None
+        en_passant = fields[3] if len(fields) > 3 else "-"
+        if en_passant != "-":
+            if len(en_passant) != 2 or en_passant[0] not in "abcdefgh" or en_passant[1] not in "36":
+                raise ValueError(f"Bad FEN en passant square {en_passant}: {fen}")
+            x = "abcdefgh".index(en_passant[0])
+            en_passant_pos = Position(x, 3 if en_passant[1] == "3" else 4)
+
+        self.set_board(board)
+        self.en_passant_pos = en_passant_pos
+        self._has_moved = has_moved
+        self.key = self.compute_key()
+        if player_sign == -1:
+            self.key ^= side_key
+
+        return player_sign
+
+    def fen(self, player_sign: int = 1) -> str:
+        """Write the position as FEN, with player_sign to move.
+
+        The board does not count moves, so the counters are always 0 1.
+        """
+        ranks = []
+        for y in range(7, -1, -1):
+            rank = ""
+            empty = 0
+            for x in range(8):
+                piece = self.squares[y * 8 + x]
+                if piece == 0:
+                    empty += 1
+                    continue
+                if empty > 0:
+                    rank += str(empty)
+                    empty = 0
+                rank += " PNBRQK"[piece] if piece > 0 else " pnbrqk"[-piece]
+            if empty > 0:
+                rank += str(empty)
+            ranks.append(rank)
+
+        castling = ""
+        for c, (king, rook) in zip("KQkq", [(4, 7), (4, 0), (60, 63), (60, 56)]):
+            sign = 1 if c.isupper() else -1
+            if (
+                not self._has_moved & fen_castling_squares[c] and
+                self.squares[king] == 6 * sign and
+                self.squares[rook] == 4 * sign
+            ):
+                castling += c
+
+        # en_passant_pos is the pawn, FEN names the square behind it
+        en_passant = "-"
+        if self.en_passant_pos is not None:
+            pos = self.en_passant_pos
+            en_passant = position_name(Position(pos.x, 2 if pos.y == 3 else 5))
+
+        side = "w" if player_sign == 1 else "b"
+        return f"{'/'.join(ranks)} {side} {castling or '-'} {en_passant} 0 1"
+
+    def compute_key(self):
+        """Compute the Zobrist key from scratch, for white to move."""
+        key = 0
+        for sq, piece in enumerate(self.squares):
+            if piece != 0:
+                key ^= piece_keys[piece][sq]
+        if self.en_passant_pos is not None:
+            key ^= en_passant_keys[self.en_passant_pos.x]
+        return key ^ castling_keys[castling_rights(self._has_moved)]
+
+    def side_key_correction(self, player_sign: int) -> int:
+        """What to XOR into key to get the key of the position with
+        player_sign to move. This is 0 unless the players have not
+        alternated since the key was set."""
+        key = self.compute_key()
+        if player_sign == -1:
+            key ^= side_key
+        return self.key ^ key
+
+    def compute_score(self):
+        """Compute Board.score from scratch."""
+        score = 0.0
+        for sq, piece in enumerate(self.squares):
+            score += piece_square_scores[piece][sq]
+        return score
+
+    def set_evaluator(self, evaluator):
+        """Evaluate with a learned evaluator (see nnue.LinearEvaluator), or
+        with Board.score alone again for None."""
+        self.evaluator = evaluator
+        self.accumulator = self.compute_accumulator() if evaluator is not None else None
+
+    def compute_accumulator(self) -> numpy.ndarray:
+        """Compute Board.accumulator from scratch."""
+        accumulator = self.evaluator.bias
+        for sq, piece in enumerate(self.squares):
+            if piece != 0:
+                accumulator = accumulator + self.evaluator.piece_weights[piece][sq]
+        return accumulator
 
-        for y in range(0, 8):
-            for x in range(0, 8):
-                self.pos_bit[Position(x, y)] = 1 << (y * 8 + x)
-    
     def is_valid_position(self, pos : Position):
-        if pos.y < 0:
-            return False
-        elif pos.x < 0:
-            return False
-        elif pos.y >= self.board.shape[0]:
-            return False
-        elif pos.x >= self.board.shape[1]:
-            return False
-
-        return True
+        return 0 <= pos.x < 8 and 0 <= pos.y < 8
 
     def find_piece_positions(self, player_sign = None):
-        ys, xs = numpy.where(self.board * player_sign > 0)
+        return [square_positions[sq] for sq in squares_of(self.occupancy[player_sign])]
+
+    def king_square(self, player_sign: int):
+        """Square number of player_sign's king, or None if it is off the board."""
+        king = self.bitboards[6 * player_sign]
+        if king == 0:
+            return None
+        return (king & -king).bit_length() - 1
+
+    def attackers(self, sq: int, player_sign: int, occupancy: int = None):
+        """Bitboard of player_sign's pieces attacking square sq.
+
+        occupancy overrides the blockers used for sliding pieces.
+        """
+        if occupancy is None:
+            occupancy = self.occupancy[0]
+        bitboards = self.bitboards
+        queens = bitboards[5 * player_sign]
+        return (
+            (pawn_attacks[-player_sign][sq] & bitboards[player_sign]) |
+            (knight_attacks[sq] & bitboards[2 * player_sign]) |
+            (king_attacks[sq] & bitboards[6 * player_sign]) |
+            (rook_tables[sq][occupancy & rook_masks[sq]] & (bitboards[4 * player_sign] | queens)) |
+            (bishop_tables[sq][occupancy & bishop_masks[sq]] & (bitboards[3 * player_sign] | queens))
+        )
+
+    def is_attacked(self, sq: int, player_sign: int, occupancy: int = None):
+        """Check whether any of player_sign's pieces attack square sq."""
+        if occupancy is None:
+            occupancy = self.occupancy[0]
+        bitboards = self.bitboards
+        if pawn_attacks[-player_sign][sq] & bitboards[player_sign]:
+            return True
+        if knight_attacks[sq] & bitboards[2 * player_sign]:
+            return True
+        if king_attacks[sq] & bitboards[6 * player_sign]:
+            return True
+        queens = bitboards[5 * player_sign]
+        if rook_tables[sq][occupancy & rook_masks[sq]] & (bitboards[4 * player_sign] | queens):
+            return True
+        if bishop_tables[sq][occupancy & bishop_masks[sq]] & (bitboards[3 * player_sign] | queens):
+            return True
+        return False
 
-        positions = []
-        for x, y in zip(xs, ys):
-            positions.append(Position(x, y))
-        return positions
+    def pinned(self, sq: int, player_sign: int):
+        """Bitboard of player_sign's pieces pinned to square sq (their king's)."""
+        bitboards = self.bitboards
+        occupancy = self.occupancy[0]
+        queens = bitboards[-5 * player_sign]
+        # Enemy sliders that would attack sq on an empty board
+        snipers = (
+            (rook_tables[sq][0] & (bitboards[-4 * player_sign] | queens)) |
+            (bishop_tables[sq][0] & (bitboards[-3 * player_sign] | queens))
+        )
+        pinned = 0
+        for sniper in squares_of(snipers):
+            blockers = between[sq][sniper] & occupancy
+            if blockers and blockers & (blockers - 1) == 0:
+                pinned |= blockers & self.occupancy[player_sign]
+        return pinned
 
     def has_moved(self, pos):
         return self._has_moved & self.pos_bit[pos] > 0
 
     def can_move_space(self, pos):
         if self.is_valid_position(pos):
-            if self.board[pos.y, pos.x] == 0:
-                return True
-            else:
-                return False
+            return self.squares[pos.y * 8 + pos.x] == 0
         return False
 
     def can_capture_space(self, pos, player_sign):
         if self.is_valid_position(pos):
-            if player_sign * self.board[pos.y, pos.x] < 0:
-                return True
-            else:
-                return False
+            return player_sign * self.squares[pos.y * 8 + pos.x] < 0
         return False
     
     def __getitem__(self, pos: Position):
-        #if not self.is_valid_position(pos):
-        #    raise Exception(f"{pos} is not a valid position")
-
-        return self.board[pos.y, pos.x]
+        return self.squares[pos.y * 8 + pos.x]
     
     def __setitem__(self, pos: Position, val):
-        #if not self.is_valid_position(pos):
-        #    raise Exception(f"{pos} is not a valid position")
-
-        self.board[pos.y, pos.x] = val
+        sq = pos.y * 8 + pos.x
+        self._clear(sq)
+        self._put(int(val), sq)
     
     def occupied(self, pos: Position):
         return self[pos] != 0
@@ -147,68 +526,104 @@ class Board:
         """Check which player is occupying a position pos."""
         return numpy.sign(self[pos])
 
-    def move(self, move: Move):
-        piece = self[move.src]
+    def _move_piece(self, src: int, dst: int):
+        # Move the piece on src to dst, capturing whatever is on dst
+        squares = self.squares
+        piece = squares[src]
+        if squares[dst] != 0:
+            self._clear(dst)
+        bits = (1 << src) | (1 << dst)
+        self.bitboards[piece] ^= bits
+        self.occupancy[1 if piece > 0 else -1] ^= bits
+        self.occupancy[0] ^= bits
+        self.key ^= piece_keys[piece][src] ^ piece_keys[piece][dst]
+        self.score += piece_square_scores[piece][dst] - piece_square_scores[piece][src]
+        if self.accumulator is not None:
+            weights = self.evaluator.piece_weights[piece]
+            self.accumulator = self.accumulator + (weights[dst] - weights[src])
+        squares[dst] = piece
+        squares[src] = 0
+
+    def move(self, move: int):
+        # move is packed as by encode_move
+        src = move & 0x3F
+        dst = (move >> 6) & 0x3F
+        piece = self.squares[src]
 
         if piece == 0:
-            raise Exception(f"No piece to move with {move}")
-        
-        removes = []
-        adds = []
+            raise Exception(f"No piece to move with {move_name(decode_move(move))}")
 
-        has_moved_copy = self._has_moved
         en_passant_pos_copy = self.en_passant_pos
-
-        def record_move(src, dst):
-            piece = self[src]
-            removes.append(PiecePosition(piece, dst))
-            adds.append(PiecePosition(piece, src))
-            adds.append(PiecePosition(self[dst], dst))
-            self[dst] = piece
-            self[src] = 0
+        unmove = Unmove(
+            self.squares, self.bitboards, self.occupancy, self.en_passant_pos, self._has_moved, self.key, self.score,
+            self.accumulator
+        )
+        self.squares = self.squares[:]
+        self.bitboards = self.bitboards[:]
+        self.occupancy = self.occupancy[:]
 
         next_en_passant_pos = None
 
-        record_move(move.src, move.dst)
+        self._move_piece(src, dst)
 
-        if isinstance(move, PromotionMove):
-            removes.append(PiecePosition(move.promoted_piece, move.dst))
-            self[move.dst] = move.promoted_piece
-            self[move.src] = 0
+        if move >> 14 == PROMOTION_FLAG:
+            promoted_piece = ((move >> 12) & 0x3) + 2
+            self._clear(dst)
+            self._put(promoted_piece if piece > 0 else -promoted_piece, dst)
         else:
-            if abs(piece) == 1:
-                if abs(move.src.y - move.dst.y) == 2:
-                    next_en_passant_pos = move.dst
+            if piece == 1 or piece == -1:
+                if abs(src - dst) == 16:
+                    next_en_passant_pos = square_positions[dst]
                 else:
-                    if self.en_passant_pos == Position(move.dst.x, move.src.y):
-                        adds.append(PiecePosition(self[self.en_passant_pos], self.en_passant_pos))
-                        self[self.en_passant_pos] = 0
-            elif abs(piece) == 6:
+                    en_passant_pos = self.en_passant_pos
+                    if en_passant_pos is not None and en_passant_pos.x == dst & 7 and en_passant_pos.y == src >> 3:
+                        self._clear(en_passant_pos.y * 8 + en_passant_pos.x)
+            elif piece == 6 or piece == -6:
             # If a king, deal with castling logic
-                for side in [0, 7]:
-                    if move.src == Position(4, side):
-                        if move.dst == Position(2, side):
-                            rook_position = Position(0, side)
-                            self._has_moved = self._has_moved | self.pos_bit[rook_position]
-                            record_move(rook_position, Position(3, side))
-                        elif move.dst == Position(6, side):
-                            rook_position = Position(7, side)
-                            self._has_moved = self._has_moved | self.pos_bit[rook_position]
-                            record_move(rook_position, Position(5, side))
-
+                for side in [0, 56]:
+                    if src == side + 4:
+                        if dst == side + 2:
+                            self._has_moved = self._has_moved | (1 << side)
+                            self._move_piece(side, side + 3)
+                        elif dst == side + 6:
+                            self._has_moved = self._has_moved | (1 << (side + 7))
+                            self._move_piece(side + 7, side + 5)
+
+        if en_passant_pos_copy is not None:
+            self.key ^= en_passant_keys[en_passant_pos_copy.x]
+        if next_en_passant_pos is not None:
+            self.key ^= en_passant_keys[next_en_passant_pos.x]
         self.en_passant_pos = next_en_passant_pos
-        self._has_moved = self._has_moved | self.pos_bit[move.src]
-        unmove = Unmove(removes, adds, en_passant_pos_copy, has_moved_copy)
+
+        # Moving onto a square counts too, so capturing a rook on its home
+        # square takes away the castling right
+        has_moved = self._has_moved | (1 << src) | (1 << dst)
+        if (has_moved ^ unmove.has_moved) & castling_squares:
+            self.key ^= castling_keys[castling_rights(unmove.has_moved)] ^ castling_keys[castling_rights(has_moved)]
+        self._has_moved = has_moved
+        self.key ^= side_key
 
         return unmove
 
-    def unmove(self, move: Unmove):
-        # Update the board with a new move
-        for pp in move.removes:
-            self[pp.pos] = 0
+    def null_move(self) -> Unmove:
+        """Pass the turn (for null move pruning). Undo it with unmove."""
+        unmove = Unmove(
+            self.squares, self.bitboards, self.occupancy, self.en_passant_pos, self._has_moved, self.key, self.score,
+            self.accumulator
+        )
+        if self.en_passant_pos is not None:
+            self.key ^= en_passant_keys[self.en_passant_pos.x]
+            self.en_passant_pos = None
+        self.key ^= side_key
+        return unmove
 
-        for pp in move.adds:
-            self[pp.pos] = pp.piece
-        
+    def unmove(self, move: Unmove):
+        # Put back the lists saved before the move
+        self.squares = move.squares
+        self.bitboards = move.bitboards
+        self.occupancy = move.occupancy
         self.en_passant_pos = move.en_passant_pos
         self._has_moved = move.has_moved
+        self.key = move.key
+        self.score = move.score
+        self.accumulator = move.accumulator
@@ -0,0 +1,127 @@
+import argparse
+import mmap
+import os
+import random
+import struct
+import sys
+from collections import defaultdict
+from typing import Iterable, List, Tuple
+from ai import legal_moves
+from board import Board, Move, encode_move, parse_move, start_fen
+from polyglot import decode_polyglot_move, encode_polyglot_move, polyglot_key
+
+# Key, move, weight and learn field of one book entry
+entry_format = struct.Struct(">QHHI")
+
+class OpeningBook:
+    """Polyglot opening book read straight from a memory-mapped .bin file.
+
+    Nothing is loaded up front: every lookup binary searches the mapped
+    file, so only the pages it touches are read in.
+    """
+    def __init__(self, path: str, seed: int = None):
+        self.path = path
+        self.random = random.Random(seed)
+        self.file = open(path, "rb")
+        # mmap cannot map an empty file
+        if os.fstat(self.file.fileno()).st_size > 0:
+            self.data = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        else:
+            self.data = b""
+        self.count = len(self.data) // entry_format.size
+
+    def close(self):
+        if isinstance(self.data, mmap.mmap):
+            self.data.close()
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __len__(self):
+        return self.count
+
+    def entries(self, key: int) -> List[Tuple[int, int]]:
+        """(move, weight) of every entry for key, in book form."""
+        # Find the first entry with a key no smaller than key
+        lo, hi = 0, self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if entry_format.unpack_from(self.data, mid * entry_format.size)[0] < key:
+                lo = mid + 1
+            else:
+                hi = mid
+
+        entries = []
+        for i in range(lo, self.count):
+            entry_key, move, weight, learn = entry_format.unpack_from(self.data, i * entry_format.size)
+            if entry_key != key:
+                break
+            entries.append((move, weight))
+        return entries
+
+    def moves(self, board: Board, player_sign: int) -> List[Tuple[Move, int]]:
+        """The legal book moves for player_sign on board and their weights."""
+        legal = legal_moves(board, player_sign)
+        moves = []
+        for book_move, weight in self.entries(polyglot_key(board, player_sign)):
+            move = decode_polyglot_move(board, book_move)
+            # Guard against key collisions and broken books
+            if encode_move(move) in legal:
+                moves.append((move, weight))
+        return moves
+
+    def pick(self, board: Board, player_sign: int) -> Move:
+        """Choose a book move at random in proportion to the weights, or
+        return None when the position is out of book."""
+        moves = [(move, weight) for move, weight in self.moves(board, player_sign) if weight > 0]
+        if len(moves) == 0:
+            return None
+        return self.random.choices([move for move, weight in moves], [weight for move, weight in moves])[0]
+
+def build_book(games: Iterable[str], plies: int = 16) -> bytes:
+    """Make a Polyglot book from games given as lines of UCI moves from the
+    start position. A move's weight is the number of games that played it
+    in that position, capped at the largest weight the format holds."""
+    counts = defaultdict(int)
+    board = Board()
+    for line in games:
+        names = line.split()
+        if len(names) == 0 or line.startswith("#"):
+            continue
+        player_sign = board.set_fen(start_fen)
+        for name in names[:plies]:
+            move = parse_move(name)
+            if encode_move(move) not in legal_moves(board, player_sign):
+                break
+            counts[polyglot_key(board, player_sign), encode_polyglot_move(board, move)] += 1
+            board.move(encode_move(move))
+            player_sign = -player_sign
+
+    # Sorted by key, and by weight within a key as Polyglot books are
+    entries = sorted(counts.items(), key=lambda item: (item[0][0], -item[1]))
+    return b"".join(entry_format.pack(key, move, min(count, 0xFFFF), 0) for (key, move), count in entries)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Build a Polyglot opening book from games in UCI notation.")
+    parser.add_argument("input", help="games file, one game of space separated UCI moves per line (- for stdin)")
+    parser.add_argument("output", help="book file to write")
+    parser.add_argument("--plies", type=int, default=16, help="moves per game to put in the book")
+    args = parser.parse_args(argv)
+
+    infile = sys.stdin if args.input == "-" else open(args.input)
+    try:
+        data = build_book(infile, args.plies)
+    finally:
+        if infile is not sys.stdin:
+            infile.close()
+    with open(args.output, "wb") as outfile:
+        outfile.write(data)
+    print(f"wrote {len(data) // entry_format.size} entries", file=sys.stderr)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
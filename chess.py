@@ -1,13 +1,21 @@
+import argparse
 import sys
 import pygame
 from pygame.locals import KEYDOWN, MOUSEBUTTONDOWN, QUIT, K_b, K_c, K_v, K_SPACE
 import numpy
 import concurrent.futures
 from board import Board, Move, PromotionMove
+from book import OpeningBook
 from state import GameState
 from ui import create_background, create_piece_sprites, create_square_sprites, draw_board
 
 
+# Command line options
+parser = argparse.ArgumentParser(description="Play chess against the AI.")
+parser.add_argument("book", nargs="?", help="Polyglot opening book for the AI")
+parser.add_argument("--cache", help="transposition table file kept between sessions")
+args = parser.parse_args()
+
 # Initialize and create UI
 executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
 pygame.init()
@@ -28,7 +36,12 @@ controls_text = small_font.render("C = AI (white),   V = AI (black),   B = undo"
 # Create clock, board and global game state
 clock = pygame.time.Clock()
 board = Board()
-state = GameState(board)
+book = OpeningBook(args.book) if args.book is not None else None
+try:
+    state = GameState(board, book=book, cache=args.cache)
+except ValueError as e:
+    # A cache file that does not fit
+    parser.error(str(e))
 
 
 def draw():
@@ -0,0 +1,188 @@
+import argparse
+import json
+import mmap
+import struct
+import sys
+from typing import Iterable, List, Tuple
+import numpy
+from board import Board, piece_square_scores
+
+# An efficiently updatable evaluator in the style of NNUE: one hidden layer
+# over sparse piece-square features, with a ReLU and a linear output. The
+# hidden layer's input sums (the accumulator) only change by a few weight
+# rows per move, so Board keeps them up to date as it moves and evaluation
+# is a single small dot product.
+#
+# Features are piece and square, feature_count of them: white pawn to king
+# and then black pawn to king, 64 squares each. Weight files are the magic,
+# the hidden layer size as a little-endian uint32 and then little-endian
+# float32 arrays: feature weights (feature_count, hidden), hidden biases
+# (hidden), output weights (hidden) and the output bias.
+
+magic = b"LEV1"
+header = struct.Struct("<4sI")
+feature_count = 12 * 64
+
+def feature(piece: int, sq: int) -> int:
+    # Feature of a signed piece on sq
+    return ((piece - 1) if piece > 0 else (5 - piece)) * 64 + sq
+
+def features(board: Board) -> List[int]:
+    return [feature(piece, sq) for sq, piece in enumerate(board.squares) if piece != 0]
+
+class LinearEvaluator:
+    """Evaluator weights memory-mapped from a file written by save.
+
+    Scores are positive when white is ahead, like evaluate_position. Attach
+    it to a board with Board.set_evaluator.
+    """
+    def __init__(self, path: str):
+        self.path = path
+        with open(path, "rb") as f:
+            self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        file_magic, hidden = header.unpack_from(self.data)
+        if file_magic != magic:
+            raise ValueError(f"{path} is not an evaluator weights file")
+        self.hidden = hidden
+
+        arrays = numpy.frombuffer(self.data, dtype="<f4", offset=header.size)
+        if len(arrays) != (feature_count + 2) * hidden + 1:
+            raise ValueError(f"{path} has the wrong size for {hidden} hidden units")
+        self.weights = arrays[:feature_count * hidden].reshape(feature_count, hidden)
+        self.bias = arrays[feature_count * hidden:(feature_count + 1) * hidden]
+        self.output_weights = arrays[(feature_count + 1) * hidden:(feature_count + 2) * hidden]
+        self.output_bias = float(arrays[-1])
+        # Weight rows by signed piece and square, indexed like
+        # Board.bitboards (negative pieces wrap around)
+        self.piece_weights = 13 * [None]
+        for piece in [1, 2, 3, 4, 5, 6, -1, -2, -3, -4, -5, -6]:
+            start = feature(piece, 0)
+            self.piece_weights[piece] = self.weights[start:start + 64]
+
+    def __getstate__(self):
+        # Sent by path alone, so every worker process maps the same weights
+        # file and its pages are shared rather than copied
+        return {"path": self.path}
+
+    def __setstate__(self, state):
+        self.__init__(state["path"])
+
+    def evaluate(self, accumulator: numpy.ndarray) -> float:
+        return float(self.output_weights.dot(numpy.maximum(accumulator, 0))) + self.output_bias
+
+def save(path: str, weights: numpy.ndarray, bias: numpy.ndarray, output_weights: numpy.ndarray, output_bias: float):
+    hidden = len(bias)
+    with open(path, "wb") as f:
+        f.write(header.pack(magic, hidden))
+        for array in [weights, bias, output_weights, numpy.array([output_bias])]:
+            f.write(numpy.asarray(array, dtype="<f4").tobytes())
+
+def handcrafted_weights(hidden: int = 2) -> Tuple[numpy.ndarray, numpy.ndarray, numpy.ndarray, float]:
+    """Weights that reproduce Board.score, material plus position bonus.
+
+    Two hidden units carry the score and its negation, so the ReLUs pass
+    one of them and the output puts the sign back. Any further units start
+    at zero, for training to make use of.
+    """
+    if hidden < 2:
+        raise ValueError("The handcrafted weights need at least 2 hidden units")
+    weights = numpy.zeros((feature_count, hidden))
+    for piece in [1, 2, 3, 4, 5, 6, -1, -2, -3, -4, -5, -6]:
+        for sq in range(64):
+            weights[feature(piece, sq), 0] = piece_square_scores[piece][sq]
+            weights[feature(piece, sq), 1] = -piece_square_scores[piece][sq]
+    output_weights = numpy.zeros(hidden)
+    output_weights[:2] = [1.0, -1.0]
+    return weights, numpy.zeros(hidden), output_weights, 0.0
+
+def read_training_positions(lines: Iterable[str]) -> Tuple[numpy.ndarray, numpy.ndarray]:
+    """Features and white's score of every position in analyse.py output.
+
+    Mates and failed positions are skipped.
+    """
+    board = Board()
+    inputs = []
+    targets = []
+    for line in lines:
+        result = json.loads(line)
+        if "score" not in result:
+            continue
+        player_sign = board.set_fen(result["fen"])
+        row = numpy.zeros(feature_count, dtype=numpy.float32)
+        row[features(board)] = 1.0
+        inputs.append(row)
+        targets.append(player_sign * result["score"])
+    return numpy.array(inputs).reshape(-1, feature_count), numpy.array(targets, dtype=numpy.float64)
+
+def train(
+    inputs: numpy.ndarray, targets: numpy.ndarray, hidden: int = 32, epochs: int = 20,
+    learning_rate: float = 0.001, batch_size: int = 256, seed: int = 0
+):
+    """Fit weights to the targets (centipawns, positive for white) with Adam
+    on the squared error, starting from handcrafted_weights plus a little
+    noise in the spare hidden units. Returns the arguments for save."""
+    rng = numpy.random.default_rng(seed)
+    weights, bias, output_weights, output_bias = handcrafted_weights(hidden)
+    weights[:, 2:] = rng.normal(0.0, 0.01, (feature_count, hidden - 2))
+    output_weights[2:] = rng.normal(0.0, 0.01, hidden - 2)
+    # Train in pawns, so the gradients are of a sane size
+    parameters = [weights / 100, bias / 100, output_weights, numpy.array([output_bias / 100])]
+    moments = [numpy.zeros_like(p) for p in parameters]
+    velocities = [numpy.zeros_like(p) for p in parameters]
+    targets = targets / 100
+
+    step = 0
+    for epoch in range(epochs):
+        order = rng.permutation(len(targets))
+        total = 0.0
+        for start in range(0, len(order), batch_size):
+            batch = order[start:start + batch_size]
+            x, y = inputs[batch], targets[batch]
+            w1, b1, w2, b2 = parameters
+            accumulator = x @ w1 + b1
+            active = numpy.maximum(accumulator, 0)
+            error = active @ w2 + b2[0] - y
+            total += float(error @ error)
+
+            # Gradients of the mean squared error
+            d_output = 2 * error / len(batch)
+            d_accumulator = numpy.outer(d_output, w2) * (accumulator > 0)
+            gradients = [x.T @ d_accumulator, d_accumulator.sum(axis=0), active.T @ d_output, numpy.array([d_output.sum()])]
+
+            step += 1
+            for p, g, m, v in zip(parameters, gradients, moments, velocities):
+                m *= 0.9
+                m += 0.1 * g
+                v *= 0.999
+                v += 0.001 * g * g
+                p -= learning_rate * (m / (1 - 0.9 ** step)) / (numpy.sqrt(v / (1 - 0.999 ** step)) + 1e-8)
+        print(f"epoch {epoch + 1}: rms error {100 * (total / len(targets)) ** 0.5:.1f} cp", file=sys.stderr)
+
+    w1, b1, w2, b2 = parameters
+    return w1 * 100, b1 * 100, w2, float(b2[0]) * 100
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Make weights for the learned evaluator.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    init_parser = subparsers.add_parser("init", help="write weights equal to the handcrafted evaluation")
+    init_parser.add_argument("output", help="weights file to write")
+    init_parser.add_argument("--hidden", type=int, default=2, help="hidden units")
+    train_parser = subparsers.add_parser("train", help="fit weights to analyse.py results")
+    train_parser.add_argument("input", help="JSON lines written by analyse.py")
+    train_parser.add_argument("output", help="weights file to write")
+    train_parser.add_argument("--hidden", type=int, default=32, help="hidden units")
+    train_parser.add_argument("--epochs", type=int, default=20)
+    train_parser.add_argument("--learning-rate", type=float, default=0.001)
+    args = parser.parse_args(argv)
+
+    if args.command == "init":
+        save(args.output, *handcrafted_weights(args.hidden))
+    else:
+        with open(args.input) as f:
+            inputs, targets = read_training_positions(f)
+        print(f"training on {len(targets)} positions", file=sys.stderr)
+        save(args.output, *train(inputs, targets, args.hidden, args.epochs, args.learning_rate))
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,136 @@
+import argparse
+import sys
+import time
+from collections import deque
+from dataclasses import dataclass
+from typing import List, Tuple
+from ai import generate_moves
+from board import Board, Move, decode_move, move_name, start_fen
+
+@dataclass(frozen=True)
+class PerftPosition:
+    name: str
+    fen: str
+    # counts[d - 1] is the number of leaf nodes at depth d
+    counts: Tuple[int, ...]
+
+# Standard perft positions with their published node counts
+reference_positions = [
+    PerftPosition("initial", start_fen, (20, 400, 8902, 197281, 4865609)),
+    PerftPosition(
+        "kiwipete",
+        "r3k2r/p1ppqpb1/bn2pnp1/3PN3/1p2P3/2N2Q1p/PPPBBPPP/R3K2R w KQkq - 0 1",
+        (48, 2039, 97862, 4085603)
+    ),
+    PerftPosition(
+        "endgame en passant",
+        "8/2p5/3p4/KP5r/1R3p1k/8/4P1P1/8 w - - 0 1",
+        (14, 191, 2812, 43238, 674624)
+    ),
+    PerftPosition(
+        "promotions",
+        "r3k2r/Pppp1ppp/1b3nbN/nP6/BBP1P3/q4N2/Pp1P2PP/R2Q1RK1 w kq - 0 1",
+        (6, 264, 9467, 422333)
+    ),
+    PerftPosition(
+        "promotion with check",
+        "rnbq1k1r/pp1Pbppp/2p5/8/2B5/8/PPP1NnPP/RNBQK2R w KQ - 1 8",
+        (44, 1486, 62379, 2103487)
+    ),
+    PerftPosition("illegal en passant", "8/5bk1/8/2Pp4/8/1K6/8/8 w - d6 0 1", (8, 104, 736, 9287, 62297, 824064)),
+    PerftPosition("en passant gives check", "8/8/1k6/2b5/2pP4/8/5K2/8 b - d3 0 1", (15, 126, 1928, 13931, 206379, 1440467)),
+    PerftPosition("short castling gives check", "5k2/8/8/8/8/8/8/4K2R w K - 0 1", (15, 66, 1198, 6399, 120330, 661072)),
+    PerftPosition("long castling gives check", "3k4/8/8/8/8/8/8/R3K3 w Q - 0 1", (16, 71, 1286, 7418, 141077, 803711)),
+    PerftPosition("castling rights", "r3k2r/1b4bq/8/8/8/8/7B/R3K2R w KQkq - 0 1", (26, 1141, 27826, 1274206)),
+    PerftPosition("castling prevented", "r3k2r/8/3Q4/8/8/5q2/8/R3K2R b KQkq - 0 1", (44, 1494, 50509, 1720476)),
+    PerftPosition("promote out of check", "2K2r2/4P3/8/8/8/8/8/3k4 w - - 0 1", (11, 133, 1442, 19174, 266199)),
+    PerftPosition("discovered check", "8/8/1P2K3/8/2n5/1q6/8/5k2 b - - 0 1", (29, 165, 5160, 31961, 1004658)),
+    PerftPosition("promote to give check", "4k3/1P6/8/8/8/8/K7/8 w - - 0 1", (9, 40, 472, 2661, 38983, 217342)),
+    PerftPosition("underpromote to give check", "8/P1k5/K7/8/8/8/8/8 w - - 0 1", (6, 27, 273, 1329, 18135, 92683, 1555980)),
+    PerftPosition("self stalemate", "K1k5/8/P7/8/8/8/8/8 w - - 0 1", (2, 6, 13, 63, 382, 2217, 15453, 93446)),
+]
+
+def perft(board: Board, player_sign: int, depth: int) -> int:
+    """Count the leaf nodes of the legal move tree depth plies deep."""
+    if depth == 0:
+        return 1
+
+    moves = generate_moves(board, player_sign, deque())
+    if depth == 1:
+        return len(moves)
+
+    nodes = 0
+    for move in moves:
+        unmove = board.move(move)
+        nodes += perft(board, -player_sign, depth - 1)
+        board.unmove(unmove)
+    return nodes
+
+def divide(board: Board, player_sign: int, depth: int) -> List[Tuple[Move, int]]:
+    """Split the perft count by root move, for comparing against other engines."""
+    counts = []
+    for move in generate_moves(board, player_sign, deque()):
+        unmove = board.move(move)
+        counts.append((decode_move(move), perft(board, -player_sign, depth - 1)))
+        board.unmove(unmove)
+    return sorted(counts, key=lambda count: move_name(count[0]))
+
+def run_suite(max_nodes: int, out=sys.stdout) -> bool:
+    """Check every reference count up to max_nodes leaves, reporting speed."""
+    board = Board()
+    passed = True
+    total_nodes = 0
+    total_time = 0.0
+    for position in reference_positions:
+        for depth, expected in enumerate(position.counts, 1):
+            if expected > max_nodes:
+                break
+            player_sign = board.set_fen(position.fen)
+            start = time.perf_counter()
+            nodes = perft(board, player_sign, depth)
+            elapsed = time.perf_counter() - start
+            total_nodes += nodes
+            total_time += elapsed
+
+            status = "ok" if nodes == expected else f"FAIL (expected {expected})"
+            passed = passed and nodes == expected
+            print(f"{position.name:28} depth {depth}  {nodes:>9} nodes  {nodes / max(elapsed, 1e-9):>9.0f} nps  {status}", file=out)
+
+    print(f"total {total_nodes} nodes in {total_time:.2f}s, {total_nodes / max(total_time, 1e-9):.0f} nps", file=out)
+    return passed
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Count move generation leaf nodes (perft).")
+    parser.add_argument("depth", type=int, nargs="?", default=3)
+    parser.add_argument("--fen", default=start_fen, help="position to start from")
+    parser.add_argument("--divide", action="store_true", help="print the count for each root move")
+    parser.add_argument(
+        "--suite", action="store_true",
+        help="check the reference positions instead, up to --max-nodes leaves each"
+    )
+    parser.add_argument("--max-nodes", type=int, default=100000)
+    args = parser.parse_args(argv)
+
+    if args.suite:
+        return 0 if run_suite(args.max_nodes) else 1
+
+    board = Board()
+    try:
+        player_sign = board.set_fen(args.fen)
+    except ValueError as e:
+        parser.error(str(e))
+    start = time.perf_counter()
+    if args.divide:
+        nodes = 0
+        for move, count in divide(board, player_sign, args.depth):
+            print(f"{move_name(move)}: {count}")
+            nodes += count
+    else:
+        nodes = perft(board, player_sign, args.depth)
+    elapsed = time.perf_counter() - start
+
+    print(f"nodes {nodes}  time {elapsed:.2f}s  nps {nodes / max(elapsed, 1e-9):.0f}")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,374 @@
+import argparse
+import ast
+import concurrent.futures
+import itertools
+import math
+import os
+import random
+import sys
+import time
+from dataclasses import dataclass
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+from ai import AIGame, legal_moves
+from analyse import read_positions
+from bitbase import Bitbases
+from board import Board, decode_move, encode_move, move_name, parse_move, start_fen
+from nnue import LinearEvaluator
+from transposition import TranspositionTable
+
+# Openings played when no suite is given, as UCI moves from the start
+# position. Every start position is played twice, with the engines swapping
+# colours.
+default_openings = [
+    "e2e4 e7e5 g1f3 b8c6 f1b5",
+    "e2e4 c7c5 g1f3 d7d6",
+    "e2e4 e7e6 d2d4 d7d5",
+    "e2e4 c7c6 d2d4 d7d5",
+    "d2d4 d7d5 c2c4 e7e6",
+    "d2d4 g8f6 c2c4 g7g6",
+    "d2d4 d7d5 c2c4 c7c6",
+    "c2c4 e7e5 b1c3",
+    "g1f3 d7d5 g2g3",
+    "e2e4 e7e5 f1c4 g8f6",
+]
+
+@dataclass
+class Adjudication:
+    # Games longer than max_plies are drawn
+    max_plies: int = 300
+    # A game is won once both engines have scored it at least resign_score
+    # for the same side over resign_moves moves each
+    resign_score: float = 1000.0
+    resign_moves: int = 3
+    # A game is drawn once both engines have scored it within draw_score of
+    # zero over draw_moves moves each, from ply draw_after on
+    draw_score: float = 10.0
+    draw_moves: int = 8
+    draw_after: int = 80
+
+def parse_setting(text: str) -> Tuple[str, object]:
+    # name=value, with the value read as a Python literal where it is one
+    name, _, value = text.partition("=")
+    try:
+        return name, ast.literal_eval(value)
+    except (ValueError, SyntaxError):
+        return name, value
+
+def make_engine(board: Board, settings: Dict[str, object], tt_size_mb: float) -> Tuple[AIGame, Optional[LinearEvaluator]]:
+    """An AIGame on board with settings applied, and the learned evaluator
+    it plays with. evaluator and bitbases take paths; everything else is an
+    AIGame attribute."""
+    game = AIGame(board, TranspositionTable(tt_size_mb))
+    evaluator = None
+    for name, value in settings.items():
+        if name == "evaluator":
+            evaluator = LinearEvaluator(value)
+        elif name == "bitbases":
+            game.bitbases = Bitbases(value)
+        elif hasattr(AIGame, name):
+            setattr(game, name, value)
+        else:
+            raise ValueError(f"AIGame has no setting {name}")
+    return game, evaluator
+
+def insufficient_material(board: Board) -> bool:
+    # Only kings and at most one knight or bishop left
+    bitboards = board.bitboards
+    if any(bitboards[piece] or bitboards[-piece] for piece in [1, 4, 5]):
+        return False
+    minors = board.occupancy[0] & ~(bitboards[6] | bitboards[-6])
+    return minors & (minors - 1) == 0
+
+def play_game(
+    white: Dict[str, object], black: Dict[str, object], fen: str, moves: List[str],
+    adjudication: Adjudication, tt_size_mb: float
+) -> Tuple[float, str, int]:
+    """Play one game, returning white's score (1, 0.5 or 0), how it ended and
+    its length in plies."""
+    board = Board()
+    player_sign = board.set_fen(fen)
+    for name in moves:
+        board.move(encode_move(parse_move(name)))
+        player_sign = -player_sign
+
+    engines = {1: make_engine(board, white, tt_size_mb), -1: make_engine(board, black, tt_size_mb)}
+    repetitions = {board.key: 1}
+    halfmove_clock = 0
+    resign_count = 0
+    draw_count = 0
+    plies = 0
+    while True:
+        if len(legal_moves(board, player_sign)) == 0:
+            king_square = board.king_square(player_sign)
+            if board.is_attacked(king_square, -player_sign):
+                return (0.0 if player_sign == 1 else 1.0), "checkmate", plies
+            return 0.5, "stalemate", plies
+        if halfmove_clock >= 100:
+            return 0.5, "fifty moves", plies
+        if repetitions[board.key] >= 3:
+            return 0.5, "repetition", plies
+        if insufficient_material(board):
+            return 0.5, "insufficient material", plies
+        if plies >= adjudication.max_plies:
+            return 0.5, "adjudicated, too long", plies
+
+        # The engines share the board, so each puts its own evaluator on it
+        engine, evaluator = engines[player_sign]
+        if evaluator is not board.evaluator:
+            board.set_evaluator(evaluator)
+        move = engine.pick_next_move(player_sign)
+        score = engine.score
+
+        # Scores are positive when white is ahead, whoever searched
+        if abs(score) >= adjudication.resign_score and resign_count * score >= 0:
+            resign_count += 1 if score > 0 else -1
+        else:
+            resign_count = 0
+        if abs(resign_count) >= 2 * adjudication.resign_moves:
+            return (1.0 if resign_count > 0 else 0.0), "adjudicated, won", plies
+        if plies >= adjudication.draw_after and abs(score) <= adjudication.draw_score:
+            draw_count += 1
+        else:
+            draw_count = 0
+        if draw_count >= 2 * adjudication.draw_moves:
+            return 0.5, "adjudicated, drawn", plies
+
+        packed = encode_move(move)
+        src, dst = packed & 0x3F, (packed >> 6) & 0x3F
+        if abs(board.squares[src]) == 1 or board.squares[dst] != 0:
+            halfmove_clock = 0
+        else:
+            halfmove_clock += 1
+        board.move(packed)
+        player_sign = -player_sign
+        plies += 1
+        repetitions[board.key] = repetitions.get(board.key, 0) + 1
+
+def opening_positions(
+    openings: List[Tuple[str, List[str]]], random_plies: int, seed: int = None
+) -> Iterator[Tuple[str, List[str]]]:
+    """Start positions for pairs of games, as (fen, moves): the openings in
+    turn, each followed by random_plies random legal moves. The engines play
+    the same moves from the same position, so every position is only given
+    once. It ends once no new position turns up."""
+    rng = random.Random(seed)
+    board = Board()
+    seen = set()
+    misses = 0
+    for i in itertools.count():
+        fen, moves = openings[i % len(openings)]
+        player_sign = board.set_fen(fen)
+        moves = list(moves)
+        for name in moves:
+            board.move(encode_move(parse_move(name)))
+            player_sign = -player_sign
+        for ply in range(random_plies):
+            legal = legal_moves(board, player_sign)
+            if len(legal) == 0:
+                break
+            move = rng.choice(legal)
+            moves.append(move_name(decode_move(move)))
+            board.move(move)
+            player_sign = -player_sign
+
+        if board.key in seen:
+            misses += 1
+            if misses >= 10 * len(openings):
+                return
+            continue
+        misses = 0
+        seen.add(board.key)
+        yield fen, moves
+
+def score_to_elo(score: float) -> float:
+    # Elo difference that expects the given score
+    score = min(max(score, 1e-6), 1 - 1e-6)
+    # (+ 0.0 so an even score shows as 0.0, not -0.0)
+    return -400 * math.log10(1 / score - 1) + 0.0
+
+def elo_to_score(elo: float) -> float:
+    return 1 / (1 + 10 ** (-elo / 400))
+
+@dataclass
+class MatchResult:
+    # Games from the first engine's point of view
+    wins: int = 0
+    draws: int = 0
+    losses: int = 0
+
+    @property
+    def games(self) -> int:
+        return self.wins + self.draws + self.losses
+
+    @property
+    def score(self) -> float:
+        return (self.wins + 0.5 * self.draws) / self.games if self.games > 0 else 0.5
+
+    def variance(self) -> float:
+        # Variance of the score of one game
+        score = self.score
+        return (
+            self.wins * (1 - score) ** 2 + self.draws * (0.5 - score) ** 2 + self.losses * score ** 2
+        ) / max(self.games, 1)
+
+    def elo(self) -> Tuple[float, Optional[float]]:
+        """Elo difference of the first engine and the half width of its 95%
+        confidence interval, or None for the width until the results vary."""
+        score = self.score
+        variance = self.variance()
+        if variance == 0:
+            return score_to_elo(score), None
+        margin = 1.96 * math.sqrt(variance / self.games)
+        return score_to_elo(score), (score_to_elo(min(score + margin, 1)) - score_to_elo(max(score - margin, 0))) / 2
+
+    def describe_elo(self) -> str:
+        elo, margin = self.elo()
+        return f"elo {elo:.1f}" if margin is None else f"elo {elo:.1f} +/- {margin:.1f}"
+
+    def llr(self, elo0: float, elo1: float) -> float:
+        """Log likelihood ratio of elo1 against elo0, from the normal
+        approximation of the game scores."""
+        variance = self.variance()
+        if self.games == 0 or variance == 0:
+            return 0.0
+        score0, score1 = elo_to_score(elo0), elo_to_score(elo1)
+        return (score1 - score0) * (2 * self.score - score0 - score1) * self.games / (2 * variance)
+
+def sprt_bounds(alpha: float, beta: float) -> Tuple[float, float]:
+    """LLR at or below the first bound accepts H0 and at or above the second
+    accepts H1."""
+    return math.log(beta / (1 - alpha)), math.log((1 - beta) / alpha)
+
+def match(
+    first: Dict[str, object], second: Dict[str, object], openings: Iterable[Tuple[str, List[str]]],
+    games: int, out=sys.stdout, workers: int = None, adjudication: Adjudication = None,
+    tt_size_mb: float = 4, elo0: float = 0.0, elo1: float = 5.0, alpha: float = 0.05, beta: float = 0.05,
+    random_plies: int = 2, seed: int = None
+) -> MatchResult:
+    """Play up to games games between two engine settings on a process pool,
+    stopping early once the SPRT of elo1 against elo0 (the first engine's
+    Elo over the second's) decides. Openings are (fen, moves) pairs, each
+    followed by random_plies random moves (see opening_positions) and then
+    played twice with colours swapped. Searches are deterministic, so the
+    match also stops once the start positions run out, rather than repeat
+    games."""
+    workers = workers or os.cpu_count() or 1
+    adjudication = adjudication or Adjudication()
+    lower, upper = sprt_bounds(alpha, beta)
+    result = MatchResult()
+    start = time.perf_counter()
+
+    def schedule():
+        # (white, black, fen, moves, whether the first engine is white) of
+        # every game to play
+        count = 0
+        for fen, moves in opening_positions(list(openings), random_plies, seed):
+            for white, black, first_white in [(first, second, True), (second, first, False)]:
+                if count >= games:
+                    return
+                yield white, black, fen, moves, first_white
+                count += 1
+        print(f"no new start positions after {count} games, stopping", file=out, flush=True)
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+        scheduled = enumerate(schedule())
+        pending = {}
+        decided = None
+        while True:
+            while decided is None and len(pending) < 2 * workers:
+                game = next(scheduled, None)
+                if game is None:
+                    break
+                number, (white, black, fen, moves, first_white) = game
+                future = executor.submit(play_game, white, black, fen, moves, adjudication, tt_size_mb)
+                pending[future] = (number, first_white)
+            if len(pending) == 0:
+                break
+
+            done, _ = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                number, first_white = pending.pop(future)
+                white_score, reason, plies = future.result()
+                score = white_score if first_white else 1 - white_score
+                if score == 1:
+                    result.wins += 1
+                elif score == 0:
+                    result.losses += 1
+                else:
+                    result.draws += 1
+
+                llr = result.llr(elo0, elo1)
+                print(
+                    f"game {number + 1} ({'first' if first_white else 'second'} white): "
+                    f"{ {1.0: '1-0', 0.5: '1/2-1/2', 0.0: '0-1'}[white_score]} {reason}, {plies} plies | "
+                    f"+{result.wins} ={result.draws} -{result.losses} "
+                    f"{result.describe_elo()} llr {llr:.2f} ({lower:.2f}, {upper:.2f})",
+                    file=out, flush=True
+                )
+                if decided is None and llr <= lower:
+                    decided = "H0"
+                elif decided is None and llr >= upper:
+                    decided = "H1"
+
+    if decided is None:
+        verdict = "SPRT undecided"
+    else:
+        verdict = f"SPRT accepts {decided}, elo {elo1 if decided == 'H1' else elo0}"
+    print(
+        f"{result.games} games in {time.perf_counter() - start:.1f}s: +{result.wins} ={result.draws} -{result.losses}, "
+        f"score {result.score:.3f}, {result.describe_elo()}, {verdict}",
+        file=out, flush=True
+    )
+    return result
+
+def read_openings(path: Optional[str]) -> List[Tuple[str, List[str]]]:
+    # FEN or EPD positions, or lines of UCI moves from the start position
+    if path is None:
+        return [(start_fen, line.split()) for line in default_openings]
+    with open(path) as f:
+        lines = [line for line in f if len(line.strip()) > 0 and not line.startswith("#")]
+    if all("/" not in line for line in lines):
+        return [(start_fen, line.split()) for line in lines]
+    return [(fen, []) for number, fen, position_id in read_positions(lines)]
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Play two engine settings against each other.")
+    parser.add_argument("--first", action="append", default=[], metavar="NAME=VALUE",
+                        help="setting of the first engine, an AIGame attribute or evaluator/bitbases path")
+    parser.add_argument("--second", action="append", default=[], metavar="NAME=VALUE",
+                        help="setting of the second engine")
+    parser.add_argument("--games", type=int, default=100, help="most games to play")
+    parser.add_argument("--openings", help="FEN/EPD file or UCI move lines to start games from")
+    parser.add_argument("--random-plies", type=int, default=2,
+                        help="random moves played after each opening, so no two game pairs start alike")
+    parser.add_argument("--seed", type=int, default=0, help="seed for the random moves")
+    parser.add_argument("--depth", type=int, help="search depth of both engines (default dmax)")
+    parser.add_argument("--movetime", type=float, help="seconds per move for both engines")
+    parser.add_argument("--workers", type=int, help="games played at once (default one per CPU)")
+    parser.add_argument("--hash", type=float, default=4, help="transposition table size per engine in MB")
+    parser.add_argument("--elo0", type=float, default=0.0, help="SPRT null hypothesis, in Elo")
+    parser.add_argument("--elo1", type=float, default=5.0, help="SPRT alternative hypothesis, in Elo")
+    parser.add_argument("--alpha", type=float, default=0.05)
+    parser.add_argument("--beta", type=float, default=0.05)
+    parser.add_argument("--max-plies", type=int, default=Adjudication.max_plies)
+    args = parser.parse_args(argv)
+
+    first = dict(parse_setting(setting) for setting in args.first)
+    second = dict(parse_setting(setting) for setting in args.second)
+    if args.depth is not None:
+        for settings in [first, second]:
+            settings.setdefault("dmax", args.depth)
+    if args.movetime is not None:
+        for settings in [first, second]:
+            settings.setdefault("time_limit", args.movetime)
+            settings.setdefault("dmax", 64)
+    match(
+        first, second, read_openings(args.openings), args.games, workers=args.workers,
+        adjudication=Adjudication(max_plies=args.max_plies), tt_size_mb=args.hash,
+        elo0=args.elo0, elo1=args.elo1, alpha=args.alpha, beta=args.beta,
+        random_plies=args.random_plies, seed=args.seed
+    )
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
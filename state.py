@@ -1,21 +1,44 @@
 import pygame
 import math
-from ai import AIGame
-from board import Board, Move, Unmove, Position
+from ai import AIGame, evaluation_fingerprint
+from book import OpeningBook
+from board import Board, Move, Position, encode_move
+from transposition import TranspositionTable
 
 
-def do_ai(board: Board, active_player_sign: int):
-    ai = AIGame(board)
-    return ai.pick_next_move(active_player_sign)
+def search(game: AIGame, active_player_sign: int):
+    move = game.pick_next_move(active_player_sign)
+    # Pondering starts from the second move of the PV
+    return move, game.extend_pv(game.pv, active_player_sign)
+
+def do_ai(board: Board, active_player_sign: int, tt: TranspositionTable = None, book: OpeningBook = None):
+    ai = AIGame(board, tt)
+    ai.book = book
+    return search(ai, active_player_sign)
 
 class GameState:
-    def __init__(self, board):
+    def __init__(self, board, ponder=True, book: OpeningBook = None, cache: str = None):
         self.board = board
+        # The AI plays from the opening book, if given, before searching
+        self.book = book
         self.selected = None
         self.hovered = None
         self.moves = []
         self.ai = None
         self.ai_move = None
+        self.ai_pv = []
+        self.ai_sign = None
+        self.executor = None
+        # The AI searches share one table, so pondering carries over. With a
+        # cache file it carries over between sessions too.
+        self.tt = TranspositionTable(AIGame.tt_size_mb, path=cache, fingerprint=evaluation_fingerprint())
+        # Pondering searches the position after the reply the AI expects,
+        # while the human is thinking
+        self.ponder_enabled = ponder
+        self.ponder = None
+        self.ponder_game = None
+        self.ponder_key = None
+        self.ponder_sign = None
         text_font = pygame.font.Font(None, 32)
         text_color = (80, 80, 180)
         self.compute_text = text_font.render("Computing...", 1, text_color)
@@ -50,6 +73,7 @@ class GameState:
             unmove = self.moves.pop()
             self.board.unmove(unmove)
             self.ai_move = None
+            self.stop_pondering()
 
     def reset_ui(self):
         """Reset highlighting things (except hover)."""
@@ -63,20 +87,55 @@ class GameState:
 
     def perform_move(self, move: Move):
         """Perform specified move and update state, if it is source occupiers turn."""
-        unmove = self.board.move(move)
+        unmove = self.board.move(encode_move(move))
         self.moves.append(unmove)
+        if self.ponder is not None and self.board.key != self.ponder_key:
+            # Not the reply the AI was pondering on
+            self.stop_pondering()
 
     def start_ai_computation(self, executor, player_sign):
         """Send AI computation to executor and update state."""
-        self.ai = executor.submit(do_ai, self.board, player_sign)
+        self.executor = executor
+        self.ai_sign = player_sign
+        if self.ponder is not None and self.board.key == self.ponder_key and player_sign == self.ponder_sign:
+            # Ponder hit, the search is already running (or done)
+            self.ai = self.ponder
+            self.ponder = None
+            self.ponder_game = None
+            return
+
+        self.stop_pondering()
+        self.ai = executor.submit(do_ai, self.board, player_sign, self.tt, self.book)
+
+    def start_pondering(self):
+        """Search the position after the expected reply in the background."""
+        if not self.ponder_enabled or self.executor is None or len(self.ai_pv) < 2:
+            return
+
+        board = self.board.copy()
+        board.move(encode_move(self.ai_pv[1]))
+        self.ponder_game = AIGame(board, self.tt)
+        self.ponder_game.book = self.book
+        self.ponder_key = board.key
+        self.ponder_sign = self.ai_sign
+        self.ponder = self.executor.submit(search, self.ponder_game, self.ponder_sign)
+
+    def stop_pondering(self):
+        """Cancel the background search, if there is one."""
+        if self.ponder is not None:
+            self.ponder_game.stop()
+            self.ponder = None
+            self.ponder_game = None
+            self.ponder_key = None
 
     def check_ai_status(self):
         """Check if AI is done and update state."""
         ai = self.ai
         if ai is not None and ai.done():
-            result = ai.result()
-            if result is not None:
-                self.ai_move = result
+            move, pv = ai.result()
+            if move is not None:
+                self.ai_move = move
+                self.ai_pv = pv
             self.ai = None
 
     def get_ai_text(self):
@@ -101,3 +160,4 @@ class GameState:
         """Execute the current suggested AI move."""
         if self.ai_move is not None:
             self.perform_move(self.ai_move)
+            self.start_pondering()
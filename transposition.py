@@ -0,0 +1,176 @@
+from typing import Optional, Tuple
+import atexit
+import multiprocessing
+import os
+import struct
+import numpy
+
+# Bound types. Scores are stored from the point of view of the side to move:
+# EXACT is the true score, LOWER means the true score is at least the stored
+# one (the node failed high) and UPPER means it is at most the stored one.
+EXACT = 0
+LOWER = 1
+UPPER = 2
+
+_score_offset = 1 << 31
+
+# Header of a table file: magic, format version and the fingerprint of the
+# evaluation its scores came from (see ai.evaluation_fingerprint), padded to
+# the size of an entry
+file_magic = b"CTT1"
+file_version = 1
+file_header = struct.Struct("<4sIQ")
+
+
+def pack_entry(depth: int, score: int, bound: int, move: int, age: int):
+    # score in bits 0-31, move in 32-47, depth in 48-55, bound in 56-57
+    # and age in 58-63
+    return (
+        (score + _score_offset) |
+        (move << 32) |
+        (depth << 48) |
+        (bound << 56) |
+        (age << 58)
+    )
+
+
+def unpack_entry(data: int):
+    """Unpack the data word of an entry into (depth, score, bound, move)."""
+    return (
+        (data >> 48) & 0xFF,
+        (data & 0xFFFFFFFF) - _score_offset,
+        (data >> 56) & 0x3,
+        (data >> 32) & 0xFFFF,
+    )
+
+
+class TranspositionTable:
+    """Fixed-size hash table of search results keyed by Board.key.
+
+    Each entry is two 64-bit words, a packed data word holding depth, score,
+    bound, best move (see board.encode_move) and the age of the search that
+    wrote it, and the key XORed with that data word. A torn write from
+    another process then just looks like a miss, so shared tables need no
+    locking.
+
+    With shared=True the table lives in shared memory. It can then be handed
+    to worker processes when they are created (for example through a process
+    pool's initargs), and every process sees the same entries.
+
+    With a path the table is a memory-mapped file of the same layout after
+    a header, kept between runs so repeated analysis starts from earlier
+    results. The file is created at size_mb if it does not exist, and
+    otherwise keeps its own size. Scores are only good for the evaluation
+    that produced them, so the file records a fingerprint of it, and a file
+    with another fingerprint (or that is not a table at all) is refused
+    with a ValueError. The file is only mapped on first use, and its pages
+    are read in as they are touched. Every process that maps the file
+    shares its entries, and the map is flushed to disk at exit.
+    """
+    entry_size: int = 16
+
+    def __init__(self, size_mb: float = 16, shared: bool = False, path: str = None, fingerprint: int = 0):
+        count = max(1, int(size_mb * (1 << 20)) // self.entry_size)
+        if path is not None and os.path.exists(path):
+            count = self.check_file(path, fingerprint)
+        # Round down to a power of two so the index is a mask
+        count = 1 << (count.bit_length() - 1)
+        self.path = path
+        if path is not None:
+            if not os.path.exists(path):
+                # A sparse file of zeros, which are empty entries
+                with open(path, "wb") as f:
+                    f.write(file_header.pack(file_magic, file_version, fingerprint))
+                    f.truncate(self.entry_size + 2 * count * 8)
+            # Mapped by __getattr__ when first used
+            self.shared_array = None
+        elif shared:
+            self.shared_array = multiprocessing.RawArray("Q", 2 * count)
+            self.table = numpy.frombuffer(self.shared_array, dtype=numpy.uint64)
+        else:
+            self.shared_array = None
+            self.table = numpy.zeros(2 * count, dtype=numpy.uint64)
+        self.mask = count - 1
+        self.age = 0
+
+    def check_file(self, path: str, fingerprint: int) -> int:
+        # Check an existing table file is one, for this evaluation, and
+        # return its entry count
+        size = os.path.getsize(path)
+        with open(path, "rb") as f:
+            header = f.read(file_header.size)
+        if len(header) < file_header.size:
+            raise ValueError(f"{path} is not a transposition table file")
+        magic, version, file_fingerprint = file_header.unpack(header)
+        count = size // self.entry_size - 1
+        if magic != file_magic or version != file_version or count <= 0 or count & (count - 1) or size % self.entry_size:
+            raise ValueError(f"{path} is not a transposition table file")
+        if file_fingerprint != fingerprint:
+            raise ValueError(f"{path} holds scores from another evaluation")
+        return count
+
+    def __getattr__(self, name):
+        # Only called for missing attributes, so this maps the file the
+        # first time the table is used and never again
+        if name != "table" or self.__dict__.get("path") is None:
+            raise AttributeError(name)
+        self.table = numpy.memmap(
+            self.path, dtype=numpy.uint64, mode="r+", offset=self.entry_size, shape=(2 * (self.mask + 1),)
+        )
+        atexit.register(self.flush)
+        return self.table
+
+    def __getstate__(self):
+        if self.shared_array is None and self.path is None:
+            return self.__dict__
+        # Only the shared array or the path travels, the table is rebuilt
+        # around it
+        state = dict(self.__dict__)
+        state.pop("table", None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if self.shared_array is not None:
+            self.table = numpy.frombuffer(self.shared_array, dtype=numpy.uint64)
+
+    def __len__(self):
+        return self.mask + 1
+
+    def new_search(self):
+        """Age the table, so entries from earlier searches get replaced first."""
+        self.age = (self.age + 1) & 0x3F
+
+    def clear(self):
+        self.table[:] = 0
+
+    def flush(self):
+        """Write a file-backed table out to disk."""
+        if "table" in self.__dict__ and self.path is not None:
+            self.table.flush()
+
+    def probe(self, key: int) -> Optional[Tuple[int, int, int, int]]:
+        """Look up key, returning (depth, score, bound, move) or None."""
+        i = 2 * (key & self.mask)
+        data = self.table.item(i + 1)
+        if self.table.item(i) ^ data != key:
+            return None
+        return unpack_entry(data)
+
+    def store(self, key: int, depth: int, score: int, bound: int, move: int):
+        i = 2 * (key & self.mask)
+        table = self.table
+        data = table.item(i + 1)
+        stored_key = table.item(i) ^ data
+
+        if stored_key == key:
+            # Keep the old best move if this search did not find one
+            if move == 0:
+                move = (data >> 32) & 0xFFFF
+        elif data != 0 and (data >> 58) == self.age and depth < (data >> 48) & 0xFF:
+            # Keep deeper results from the current search
+            return
+
+        data = pack_entry(min(depth, 0xFF), int(score), bound, move, self.age)
+        table[i] = key ^ data
+        table[i + 1] = data
@@ -0,0 +1,243 @@
+import sys
+import threading
+from ai import AIGame, SearchInfo, evaluation_fingerprint, mate_moves
+from board import Board, encode_move, move_name, parse_move, start_fen
+from bitbase import Bitbases
+from book import OpeningBook
+from nnue import LinearEvaluator
+from transposition import TranspositionTable
+
+# Depth cap for searches bounded only by time, nodes or stop
+max_depth = 64
+
+# Time kept back from every move for overhead, in seconds
+move_overhead = 0.05
+
+def time_budget(remaining: float, increment: float, moves_to_go: int = None):
+    """Seconds to spend on a move given the clock (all times in seconds)."""
+    budget = remaining / (moves_to_go or 30) + 0.75 * increment
+    return max(0.01, min(budget, remaining - move_overhead))
+
+class UCIEngine:
+    """Universal Chess Interface front end for AIGame.
+
+    Commands come in through handle and replies go to out. Searches run in a
+    background thread, so isready and stop are answered while thinking.
+    """
+    def __init__(self, out=sys.stdout):
+        self.out = out
+        self.board = Board()
+        self.player_sign = 1
+        self.game = AIGame(self.board)
+        self.threads = 1
+        self.hash_mb = AIGame.tt_size_mb
+        self.hash_file = None
+        # Hash, HashFile and evaluation fingerprint the table was made for
+        self.table_settings = (self.hash_mb, None, evaluation_fingerprint())
+        self.search_thread = None
+        self.infinite = False
+
+    def send(self, line: str):
+        print(line, file=self.out, flush=True)
+
+    def handle(self, line: str) -> bool:
+        """Handle one command, returning False when the engine should quit."""
+        tokens = line.split()
+        if len(tokens) == 0:
+            return True
+        command, args = tokens[0], tokens[1:]
+
+        if command == "uci":
+            self.send("id name chess")
+            self.send("id author chess contributors")
+            self.send(f"option name Hash type spin default {AIGame.tt_size_mb} min 1 max 4096")
+            self.send("option name Threads type spin default 1 min 1 max 256")
+            self.send("option name Book type string default <empty>")
+            self.send("option name Bitbases type string default <empty>")
+            self.send("option name HashFile type string default <empty>")
+            self.send("option name EvalFile type string default <empty>")
+            self.send("uciok")
+        elif command == "isready":
+            self.send("readyok")
+        elif command == "ucinewgame":
+            self.wait()
+            # A hash file is kept for later games
+            if self.hash_file is None:
+                self.game.tt.clear()
+        elif command == "setoption":
+            self.wait()
+            self.set_option(args)
+        elif command == "position":
+            self.wait()
+            self.set_position(args)
+        elif command == "go":
+            self.wait()
+            self.go(args)
+        elif command == "stop":
+            self.wait(stop=True)
+        elif command == "quit":
+            self.wait(stop=True)
+            return False
+        else:
+            self.send(f"info string unknown command {command}")
+        return True
+
+    def wait(self, stop: bool = False):
+        # Wait for the running search, if any, to send its bestmove
+        if self.search_thread is not None:
+            if stop:
+                self.game.stop()
+            self.search_thread.join()
+            self.search_thread = None
+
+    def set_option(self, args):
+        # setoption name <name> value <value>
+        if "value" not in args or args[0] != "name":
+            return
+        name = " ".join(args[1:args.index("value")]).lower()
+        value = " ".join(args[args.index("value") + 1:])
+        try:
+            if name == "hash":
+                self.hash_mb = float(value)
+            elif name == "evalfile":
+                self.board.set_evaluator(LinearEvaluator(value) if value not in ["", "<empty>"] else None)
+            elif name == "hashfile":
+                self.hash_file = value if value not in ["", "<empty>"] else None
+            elif name == "threads":
+                self.threads = max(1, int(value))
+            elif name == "book":
+                if self.game.book is not None:
+                    self.game.book.close()
+                    self.game.book = None
+                if value not in ["", "<empty>"]:
+                    self.game.book = OpeningBook(value)
+            elif name == "bitbases":
+                if self.game.bitbases is not None:
+                    self.game.bitbases.close()
+                    self.game.bitbases = None
+                if value not in ["", "<empty>"]:
+                    self.game.bitbases = Bitbases(value)
+            else:
+                self.send(f"info string unknown option {name}")
+        except (ValueError, OSError):
+            self.send(f"info string bad value {value} for option {name}")
+
+    def update_table(self):
+        # Make a new table if Hash, HashFile or the evaluation changed since
+        # the last one. This waits for go, as a hash file has to match the
+        # evaluation, which other options set in any order.
+        fingerprint = evaluation_fingerprint(self.board.evaluator, self.game.bitbases)
+        settings = (self.hash_mb, self.hash_file, fingerprint)
+        if settings == self.table_settings:
+            return
+        self.table_settings = settings
+        try:
+            self.game.tt = TranspositionTable(self.hash_mb, path=self.hash_file, fingerprint=fingerprint)
+        except (ValueError, OSError) as e:
+            self.send(f"info string {e}, using a table in memory")
+            self.game.tt = TranspositionTable(self.hash_mb)
+
+    def set_position(self, args):
+        # position [startpos | fen <fen>] [moves <move> ...]
+        if "moves" in args:
+            moves = args[args.index("moves") + 1:]
+            args = args[:args.index("moves")]
+        else:
+            moves = []
+
+        try:
+            if len(args) > 0 and args[0] == "fen":
+                self.player_sign = self.board.set_fen(" ".join(args[1:]))
+            else:
+                self.player_sign = self.board.set_fen(start_fen)
+
+            for name in moves:
+                self.board.move(encode_move(parse_move(name)))
+                self.player_sign = -self.player_sign
+        except Exception as e:
+            self.send(f"info string bad position: {e}")
+            self.player_sign = self.board.set_fen(start_fen)
+
+    def go(self, args):
+        limits = {}
+        infinite = False
+        i = 0
+        while i < len(args):
+            if args[i] == "infinite":
+                infinite = True
+                i += 1
+            elif args[i] in ["depth", "movetime", "wtime", "btime", "winc", "binc", "movestogo", "nodes"] and i + 1 < len(args):
+                try:
+                    limits[args[i]] = int(args[i + 1])
+                except ValueError:
+                    self.send(f"info string bad value {args[i + 1]} for {args[i]}")
+                i += 2
+            else:
+                i += 1
+
+        self.update_table()
+        game = self.game
+        game.dmax = limits.get("depth", max_depth)
+        game.node_limit = limits.get("nodes")
+        if "movetime" in limits:
+            game.time_limit = limits["movetime"] / 1000
+        elif not infinite and ("wtime" in limits or "btime" in limits):
+            clock, increment = ("wtime", "winc") if self.player_sign == 1 else ("btime", "binc")
+            game.time_limit = time_budget(
+                limits.get(clock, 0) / 1000, limits.get(increment, 0) / 1000, limits.get("movestogo")
+            )
+        else:
+            game.time_limit = None
+        game.on_iteration = self.send_info
+        game.workers = self.threads
+
+        self.infinite = infinite
+        # Cleared before the thread starts, so a stop sent right after go is
+        # not lost
+        game.stop_event.clear()
+        self.search_thread = threading.Thread(target=self.search, args=(infinite,), daemon=True)
+        self.search_thread.start()
+
+    def search(self, infinite: bool):
+        game = self.game
+        if self.threads > 1:
+            move = game.pick_next_move_parallel(self.player_sign)
+        else:
+            move = game.pick_next_move(self.player_sign)
+
+        if infinite:
+            # bestmove has to wait for stop
+            game.stop_event.wait()
+
+        pv = game.extend_pv(game.pv, self.player_sign)
+        if move is None:
+            self.send("bestmove 0000")
+        elif len(pv) > 1:
+            self.send(f"bestmove {move_name(move)} ponder {move_name(pv[1])}")
+        else:
+            self.send(f"bestmove {move_name(move)}")
+
+    def send_info(self, info: SearchInfo):
+        # UCI scores are from the side to move's point of view
+        score = self.player_sign * info.score
+        mate = mate_moves(score)
+        score = f"mate {mate}" if mate is not None else f"cp {round(score)}"
+        nps = int(info.nodes / info.time) if info.time > 0 else 0
+        pv = " ".join(move_name(move) for move in self.game.extend_pv(info.pv, self.player_sign))
+        self.send(
+            f"info depth {info.depth} score {score} nodes {info.nodes} nps {nps} "
+            f"time {int(info.time * 1000)} pv {pv}"
+        )
+
+def main():
+    engine = UCIEngine()
+    for line in sys.stdin:
+        if not engine.handle(line):
+            break
+    else:
+        # End of input, so let a piped search finish unless nothing would end it
+        engine.wait(stop=engine.infinite)
+    engine.game.close()
+
+if __name__ == "__main__":
+    main()